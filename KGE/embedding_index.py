@@ -0,0 +1,105 @@
+"""
+Approximate nearest-neighbour search over the entity embeddings written by the export-* commands of main.py, without
+loading the torch model or connecting to the KG.
+
+Usage: python embedding_index.py <embedding directory> <group> <graph id> [k]
+e.g. python embedding_index.py embeddings_transe report 1234 10
+"""
+import os
+import sys
+
+import numpy as np
+
+# entity embeddings are compared with the nprobe closest of sqrt(n) clusters, the k-means fit uses a sample
+NUM_PROBES = 8
+KMEANS_ITERATIONS = 20
+KMEANS_SAMPLE_SIZE = 100000
+ASSIGN_CHUNK_SIZE = 65536
+
+
+def _squared_distances(vectors, centroids):
+    return (np.square(vectors).sum(axis=1)[:, None] - 2 * vectors @ centroids.T
+            + np.square(centroids).sum(axis=1)[None, :])
+
+
+def _assign(vectors, centroids):
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_CHUNK_SIZE):
+        chunk = np.asarray(vectors[start:start + ASSIGN_CHUNK_SIZE], dtype=np.float32)
+        assignment[start:start + len(chunk)] = _squared_distances(chunk, centroids).argmin(axis=1)
+    return assignment
+
+
+def build_index(directory, group, num_clusters=None, seed=0):
+    """
+    Builds the inverted file index of an entity group: the embeddings of its members are clustered with k-means and
+    the members are stored sorted by cluster, together with the offset of each cluster.
+    """
+    embeddings = np.load(os.path.join(directory, "entity_embeddings.npy"), mmap_mode="r")
+    members = np.load(os.path.join(directory, f"group_{group}.npy"))
+    vectors = embeddings[members]
+    num_clusters = num_clusters or max(1, int(np.sqrt(len(members))))
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(len(vectors), KMEANS_SAMPLE_SIZE), replace=False)]
+    centroids = sample[rng.choice(len(sample), min(num_clusters, len(sample)), replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = _assign(sample, centroids)
+        for cluster in range(len(centroids)):
+            cluster_vectors = sample[assignment == cluster]
+            if len(cluster_vectors):
+                centroids[cluster] = cluster_vectors.mean(axis=0)
+    assignment = _assign(vectors, centroids)
+    order = np.argsort(assignment, kind="stable")
+    offsets = np.searchsorted(assignment[order], np.arange(len(centroids) + 1))
+    np.save(os.path.join(directory, f"index_{group}_centroids.npy"), centroids)
+    np.save(os.path.join(directory, f"index_{group}_members.npy"), members[order])
+    np.save(os.path.join(directory, f"index_{group}_offsets.npy"), offsets)
+
+
+class EmbeddingIndex:
+    """
+    Memory-mapped inverted file index of an entity group, queries are answered by an exact search over the members
+    of the nprobe clusters closest to the query embedding.
+    """
+
+    def __init__(self, directory, group):
+        if not os.path.exists(os.path.join(directory, f"index_{group}_centroids.npy")):
+            build_index(directory, group)
+        self.embeddings = np.load(os.path.join(directory, "entity_embeddings.npy"), mmap_mode="r")
+        self.entity_ids = np.load(os.path.join(directory, "entity_ids.npy"), mmap_mode="r")
+        self.centroids = np.load(os.path.join(directory, f"index_{group}_centroids.npy"))
+        self.members = np.load(os.path.join(directory, f"index_{group}_members.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(directory, f"index_{group}_offsets.npy"))
+
+    def entity(self, graph_id):
+        index = int(np.searchsorted(self.entity_ids, graph_id))
+        if index == len(self.entity_ids) or self.entity_ids[index] != graph_id:
+            raise KeyError(f"{graph_id} is not part of the exported embeddings")
+        return index
+
+    def search(self, vector, k=10, nprobe=NUM_PROBES, exclude=None):
+        """
+        Returns the graph ids and euclidean distances of the (approximately) k nearest group members of vector.
+        """
+        vector = np.asarray(vector, dtype=np.float32)[None, :]
+        clusters = np.argsort(_squared_distances(vector, self.centroids)[0])[:nprobe]
+        candidates = np.concatenate([self.members[self.offsets[c]:self.offsets[c + 1]] for c in clusters])
+        if exclude is not None:
+            candidates = candidates[candidates != exclude]
+        distances = np.sqrt(np.maximum(_squared_distances(vector, np.asarray(self.embeddings[candidates]))[0], 0))
+        best = np.argsort(distances)[:k]
+        return np.asarray(self.entity_ids)[candidates[best]], distances[best]
+
+    def similar(self, graph_id, k=10, nprobe=NUM_PROBES):
+        """
+        Returns the graph ids and distances of the k group members most similar to the entity graph_id.
+        """
+        entity = self.entity(graph_id)
+        return self.search(self.embeddings[entity], k, nprobe, exclude=entity)
+
+
+if __name__ == "__main__":
+    directory, group, graph_id = sys.argv[1], sys.argv[2], int(sys.argv[3])
+    k = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+    for neighbour, distance in zip(*EmbeddingIndex(directory, group).similar(graph_id, k)):
+        print(f"{neighbour}\t{distance}")
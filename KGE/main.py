@@ -1,14 +1,30 @@
+import hashlib
+import inspect
+import json
 import os
+import resource
+import shutil
 import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 
-import pandas as pd
+import numpy as np
+import optuna
 import torch
 from dotenv import load_dotenv
 from neo4j import GraphDatabase
+from optuna.trial import TrialState
+from pykeen.evaluation import RankBasedEvaluator
 from pykeen.hpo import hpo_pipeline
+from pykeen.models import model_resolver
 from pykeen.pipeline import pipeline
-from pykeen.predict import predict_target
-from pykeen.triples import TriplesFactory
+from pykeen.triples import CoreTriplesFactory
+from pykeen.utils import resolve_device
+
+import metrics
+from embedding_index import build_index
+from scoring_service import TagScorer, serve
 
 load_dotenv()
 
@@ -17,265 +33,878 @@ URI = os.getenv("KG_URI")
 PASSWORD = os.getenv("KG_PASSWORD")
 AUTH = (USER, PASSWORD)
 
+# months of the Status timestamps used for the tags of the training, testing and validation triples
+TRAINING_MONTHS = [1, 2]
+TESTING_MONTHS = [3]
+VALIDATION_MONTHS = [4]
+TAGGED_MONTHS = TRAINING_MONTHS + TESTING_MONTHS + VALIDATION_MONTHS
+PREDICTION_MONTHS = [5, 6]
+# tags to these trash types are part of the graph, but not of the training, testing or validation triples
+EXCLUDED_TAG_LABELS = ["math_count", "image_noise"]
+
+# directory of the local triple snapshots, one sub directory per graph fingerprint, only the current snapshot and the
+# snapshots of the stored models (result_* directories) are kept
+TRIPLE_CACHE_DIR = "triple_cache"
+# incremented whenever the snapshot format changes
+SNAPSHOT_VERSION = 2
+# number of records the driver fetches per batch while streaming query results
+FETCH_SIZE = 10000
+
+# batched tag scoring: maximum number of reports scored per forward pass, further limited by the memory budget
+# (in bytes) for the intermediate score tensors of one batch
+PREDICTION_BATCH_SIZE = 16384
+PREDICTION_MEMORY_LIMIT = 2 * 1024 ** 3
+
+# 4.07% of the possible options are actually tagged (in the training data), adjusted for multi-tags (multiple edges to same trash type)
+TAG_FRACTION = 407 / 10000
+# optional additional restrictions of the predicted tags: best k trash types per report, minimum score
+TAGS_PER_REPORT = None
+TAG_SCORE_THRESHOLD = None
+# incremental prediction and scoring service: reports created after the snapshot of the models are scored by up to
+# NEIGHBOUR_REPORTS of the latest reports of their pickup (or of its LAYER_2 cluster), looked up for
+# NEIGHBOUR_CHUNK_SIZE reports per query
+NEIGHBOUR_REPORTS = 50
+NEIGHBOUR_CHUNK_SIZE = 1000
+
+# ensemble of independently trained models (one PREDICTED_TAGS_* edge type per replica), trained in parallel
+# worker processes with a limited number of torch threads each
+ENSEMBLE_SIZE = 10
+ENSEMBLE_WORKERS = 4
+ENSEMBLE_SEED = 1000
+THREADS_PER_WORKER = max(1, (os.cpu_count() or 1) // ENSEMBLE_WORKERS)
+
+# embedding export: entity groups (relation type and position of their members) that get a nearest-neighbour index
+EMBEDDING_GROUPS = {
+    "report": ("status", 0),
+    "status": ("status", 2),
+    "pickup": ("location", 0),
+    "pickup_layer_1": ("report", 0),
+    "location": ("location", 2),
+    "trashtype": ("tag", 2),
+}
+INDEXED_GROUPS = ["report", "pickup"]
+EXPORT_CHUNK_SIZE = 65536
+
+# benchmark: models trained (or reused) on the current triple snapshot, one JSON line per model is appended to
+# BENCHMARK_FILE
+BENCHMARK_MODELS = ["transe", "pairre", "tucker"]
+BENCHMARK_FILE = "benchmark.jsonl"
+BENCHMARK_HITS_AT = [1, 3, 10]
+BENCHMARK_REUSE_MODELS = True
+
+# hyperparameter optimization: the trials of all workers are stored in (and resumed from) a persistent optuna
+# study per model, unpromising trials are pruned based on the validation results of the early stopper
+HPO_STORAGE = "sqlite:///hpo.db"
+HPO_WORKERS = 4
+HPO_PRUNER = "median"
+HPO_PRUNER_KWARGS = dict(n_startup_trials=10, n_warmup_steps=20)
+# the best pipeline configuration of each study is exported to HPO_RESULTS_DIR/<model>/best_pipeline
+HPO_RESULTS_DIR = "hpo"
+# train the predict-* models with the exported best configuration instead of the defaults of the training_* functions
+USE_HPO_CONFIG = False
+
+# number of predicted tag edges written / deleted per transaction
+WRITE_CHUNK_SIZE = 5000
+DELETE_CHUNK_SIZE = 10000
+
 
 def get_triples(tx):
+    """
+    Fetches all triples once, together with the month of the Status timestamp they belong to, the train/test/validation
+    split is done locally by split_triples. Nodes are identified by their integer id, the year/month/day literals by
+    their value. The records are streamed into typed arrays, relation types are stored as codes into the returned
+    relation labels.
+    """
     result = tx.run(
         """
         MATCH (s:Report)-[r:status]->(status:Status)
-        RETURN toString(id(s)) as source, toString(id(status)) AS target, type(r) as type
+        RETURN id(s) as source, id(status) AS target, type(r) as type,
+            status.timestamp.month as month, false as excluded
         UNION
         MATCH (s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [1,2,3,4]
+        WHERE status.timestamp.month IN $tagged_months
         CALL {
             WITH s
             MATCH (s)-[r:tag]->(t:TrashType)
             return r, t
         }
-        RETURN distinct toString(id(s)) as source, toString(id(t)) AS target, type(r) as type
+        RETURN distinct id(s) as source, id(t) AS target, type(r) as type,
+            status.timestamp.month as month, coalesce(t.label IN $excluded_labels, true) as excluded
         UNION
         MATCH (s:Report)-[:status]->(status:Status)
-        RETURN toString(id(status)) as source, toString(status.timestamp.year) AS target, "status_year" as type
+        RETURN id(status) as source, status.timestamp.year AS target, "status_year" as type,
+            status.timestamp.month as month, false as excluded
         UNION
         MATCH (s:Report)-[:status]->(status:Status)
-        RETURN toString(id(status)) as source, toString(status.timestamp.month) AS target, "status_month" as type
+        RETURN id(status) as source, status.timestamp.month AS target, "status_month" as type,
+            status.timestamp.month as month, false as excluded
         UNION
         MATCH (s:Report)-[:status]->(status:Status)
-        RETURN toString(id(status)) as source, toString(status.timestamp.day) AS target, "status_day" as type
+        RETURN id(status) as source, status.timestamp.day AS target, "status_day" as type,
+            status.timestamp.month as month, false as excluded
         UNION
         MATCH (p2:PickUp:LAYER_2)-[r2:contains]->(p:PickUp:LAYER_1)-[r1:report]->(s:Report)-[:status]->(status:Status)
         CALL {
             WITH p2
             MATCH (p2)-[r3:location]->(l:Location)
-            return toString(id(p2)) as source, toString(id(l)) AS target, type(r3) as type
+            return id(p2) as source, id(l) AS target, type(r3) as type
         }
-        RETURN source, target, type
+        RETURN source, target, type, status.timestamp.month as month, false as excluded
         UNION 
         MATCH (p2:PickUp:LAYER_2)-[r2:contains]->(p:PickUp:LAYER_1)-[r1:report]->(s:Report)-[:status]->(status:Status)
-        RETURN toString(id(p2)) as source, toString(id(p)) AS target, type(r2) as type 
+        RETURN id(p2) as source, id(p) AS target, type(r2) as type,
+            status.timestamp.month as month, false as excluded
         UNION 
         MATCH (p:PickUp:LAYER_1)-[r1:report]->(s:Report)-[:status]->(status:Status)
-        RETURN toString(id(p)) as source, toString(id(s)) AS target, type(r1) as type
-        """)
-    return pd.DataFrame([r.values() for r in result], columns=result.keys())
+        RETURN id(p) as source, id(s) AS target, type(r1) as type,
+            status.timestamp.month as month, false as excluded
+        """, {'tagged_months': TAGGED_MONTHS, 'excluded_labels': EXCLUDED_TAG_LABELS})
+    sources, targets, relations = array("q"), array("q"), array("B")
+    months, excluded = array("b"), array("B")
+    relation_codes = {}
+    for source, target, relation, month, is_excluded in result:
+        sources.append(source)
+        targets.append(target)
+        relations.append(relation_codes.setdefault(relation, len(relation_codes)))
+        months.append(month)
+        excluded.append(is_excluded)
+    return {
+        "source": np.frombuffer(sources, dtype=np.int64),
+        "target": np.frombuffer(targets, dtype=np.int64),
+        "relation": np.frombuffer(relations, dtype=np.uint8),
+        "relation_labels": np.array(list(relation_codes), dtype=str),
+        "month": np.frombuffer(months, dtype=np.int8),
+        "excluded": np.frombuffer(excluded, dtype=bool),
+    }
+
+
+def get_graph_fingerprint(tx):
+    """
+    Cheap fingerprint of the graph (node and relationship counts, latest Status timestamp) together with the
+    split configuration, used as key of the triple snapshot cache. Only the node labels and relationship types the
+    triples are extracted from are counted, writing predicted tags doesn't change the fingerprint.
+    """
+    nodes = tx.run("""
+        MATCH (n)
+        WHERE n:Report OR n:Status OR n:TrashType OR n:PickUp OR n:Location
+        RETURN count(n) as count
+        """).single()["count"]
+    relationships = tx.run("""
+        MATCH ()-[r:status|tag|contains|report|location]->()
+        RETURN count(r) as count
+        """).single()["count"]
+    last_status = tx.run("MATCH (s:Status) RETURN toString(max(s.timestamp)) as last").single()["last"]
+    key = f"{SNAPSHOT_VERSION}|{nodes}|{relationships}|{last_status}|{TAGGED_MONTHS}|{EXCLUDED_TAG_LABELS}"
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
 
 
-def get_training_triples(tx):
+def build_snapshot(triples):
+    """
+    Converts the result of get_triples into a columnar snapshot: sorted entity graph ids and relation labels (the id
+    of an entity/relation is its position) and the mapped triples with their month and excluded flag.
+    """
+    n = len(triples["source"])
+    entity_ids, entities = np.unique(np.concatenate([triples["source"], triples["target"]]), return_inverse=True)
+    order = np.argsort(triples["relation_labels"])
+    relation_labels = triples["relation_labels"][order]
+    relations = np.argsort(order)[triples["relation"]]
+    return {
+        "entity_ids": entity_ids,
+        "relation_labels": relation_labels,
+        "triples": np.stack([entities[:n], relations, entities[n:]], axis=1).astype(np.int64),
+        "month": triples["month"],
+        "excluded": triples["excluded"],
+    }
+
+
+def map_entities(snapshot, graph_ids):
+    """
+    Maps graph ids to the entity ids of a snapshot, ids that are not part of the snapshot are mapped to -1.
+    """
+    entity_ids = np.asarray(snapshot["entity_ids"])
+    graph_ids = np.asarray(graph_ids, dtype=np.int64)
+    index = np.minimum(np.searchsorted(entity_ids, graph_ids), len(entity_ids) - 1)
+    return np.where(entity_ids[index] == graph_ids, index, -1)
+
+
+def relation_id(snapshot, label):
+    return snapshot["relation_labels"].tolist().index(label)
+
+
+def save_snapshot(snapshot, path):
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for key, values in snapshot.items():
+        np.save(os.path.join(tmp_path, f"{key}.npy"), values)
+    # only complete snapshots are visible under the fingerprint
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path):
+    return {
+        file[:-len(".npy")]: np.load(os.path.join(path, file), mmap_mode="r")
+        for file in os.listdir(path) if file.endswith(".npy")
+    }
+
+
+def prune_triple_cache(fingerprint, cache_dir=TRIPLE_CACHE_DIR):
+    """
+    Removes the snapshots of cache_dir except the one of fingerprint and the ones the stored models were trained on,
+    which incremental predictions still score with (see cached_ensemble_fingerprint).
+    """
+    keep = {fingerprint}
+    for directory in os.listdir("."):
+        meta = _model_meta(directory) if directory.startswith("result_") else None
+        if meta is not None:
+            keep.add(meta["snapshot"])
+    # snapshots that are still being written are only visible under their .tmp path
+    stale = [entry for entry in os.listdir(cache_dir) if entry not in keep and not entry.endswith(".tmp")]
+    for entry in stale:
+        shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+    if stale:
+        print(f"removed {len(stale)} unused triple snapshots")
+
+
+def load_triples(session, cache_dir=TRIPLE_CACHE_DIR):
+    """
+    Returns the fingerprint and the triple snapshot of the graph, the triples are only fetched from the graph if
+    there is no snapshot for the current fingerprint in cache_dir.
+    """
+    with metrics.span("db.get_graph_fingerprint"):
+        fingerprint = session.execute_read(get_graph_fingerprint)
+    path = os.path.join(cache_dir, fingerprint)
+    if os.path.isdir(path):
+        print(f"loading triple snapshot {path}")
+        prune_triple_cache(fingerprint, cache_dir)
+        return fingerprint, load_snapshot(path)
+    with metrics.span("db.get_triples") as timer:
+        snapshot = build_snapshot(session.execute_read(get_triples))
+    metrics.count("triples_read", len(snapshot['triples']))
+    metrics.throughput("triples_read", len(snapshot['triples']), timer.seconds)
+    print(f"fetched {len(snapshot['triples'])} triples")
+    os.makedirs(cache_dir, exist_ok=True)
+    save_snapshot(snapshot, path)
+    print(f"stored triple snapshot {path}")
+    prune_triple_cache(fingerprint, cache_dir)
+    return fingerprint, snapshot
+
+
+def split_triples(snapshot):
+    """
+    Builds the triples factory of the whole graph and the training, testing and validation factories from a
+    triple snapshot. Report-Status edges are part of every split, all other triples only of the split of
+    their month.
+    """
+    num_entities = len(snapshot["entity_ids"])
+    num_relations = len(snapshot["relation_labels"])
+    status = relation_id(snapshot, "status")
+    triples = np.asarray(snapshot["triples"])
+    month = np.asarray(snapshot["month"])
+    excluded = np.asarray(snapshot["excluded"])
+
+    def factory(mapped_triples):
+        return CoreTriplesFactory(
+            mapped_triples=torch.as_tensor(np.unique(mapped_triples, axis=0)),
+            num_entities=num_entities,
+            num_relations=num_relations
+        )
+
+    def subset(months):
+        mask = (triples[:, 1] == status) | (np.isin(month, months) & ~excluded)
+        return factory(triples[mask])
+
+    tf = factory(triples)
+    return tf, subset(TRAINING_MONTHS), subset(TESTING_MONTHS), subset(VALIDATION_MONTHS)
+
+
+def prediction_query(tx, since=None):
+    """
+    Returns the ids of the reports to predict tags for and the latest Status timestamp among them, either all reports
+    of the PREDICTION_MONTHS or the reports with a Status newer than since.
+    """
+    if since is None:
+        condition, parameters = "status.timestamp.month IN $months", {'months': PREDICTION_MONTHS}
+    else:
+        condition, parameters = "status.timestamp > $since", {'since': since}
     result = tx.run(
-        """
-        MATCH (s:Report)-[r:status]->(status:Status)
-        RETURN toString(id(s)) as source, toString(id(status)) AS target, type(r) as type
-        UNION
-        MATCH (s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [1,2]
-        CALL {
-            WITH s
-            MATCH (s)-[r:tag]->(t:TrashType)
-            where not (t.label = "math_count") and not (t.label = "image_noise")
-            return r,t
-        }
-        RETURN distinct toString(id(s)) as source, toString(id(t)) AS target, type(r) as type
-        UNION
-        MATCH (s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [1,2]
-        RETURN toString(id(status)) as source, toString(status.timestamp.year) AS target, "status_year" as type
-        UNION
+        f"""
         MATCH (s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [1,2]
-        RETURN toString(id(status)) as source, toString(status.timestamp.month) AS target, "status_month" as type
-        UNION
+        WHERE {condition}
+        RETURN id(s) as id
+        """, parameters)
+    ids = np.fromiter((record[0] for record in result), dtype=np.int64)
+    last_timestamp = tx.run(
+        f"""
         MATCH (s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [1,2]
-        RETURN toString(id(status)) as source, toString(status.timestamp.day) AS target, "status_day" as type
-        UNION
-        MATCH (p2:PickUp:LAYER_2)-[r2:contains]->(p:PickUp:LAYER_1)-[r1:report]->(s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [1,2]
-        CALL {
-            WITH p2
-            MATCH (p2)-[r3:location]->(l:Location)
-            return toString(id(p2)) as source, toString(id(l)) AS target, type(r3) as type
-        }
-        RETURN source, target, type
-        UNION 
-        MATCH (p2:PickUp:LAYER_2)-[r2:contains]->(p:PickUp:LAYER_1)-[r1:report]->(s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [1,2]
-        RETURN toString(id(p2)) as source, toString(id(p)) AS target, type(r2) as type 
-        UNION 
-        MATCH (p:PickUp:LAYER_1)-[r1:report]->(s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [1,2]
-        RETURN toString(id(p)) as source, toString(id(s)) AS target, type(r1) as type
-        """)
-    return pd.DataFrame([r.values() for r in result], columns=result.keys())
+        WHERE {condition}
+        RETURN max(status.timestamp) as last
+        """, parameters).single()["last"]
+    return ids, last_timestamp
 
 
-def get_test_triples(tx):
-    result = tx.run(
+def get_high_water_mark(tx, scored_ids, skipped_ids):
+    """
+    Returns the latest Status timestamp of the scored reports that is older than every Status of the skipped reports
+    (None if there is none), so that a later incremental run still predicts the skipped reports.
+    """
+    return tx.run(
         """
-        MATCH (s:Report)-[r:status]->(status:Status)
-        RETURN toString(id(s)) as source, toString(id(status)) AS target, type(r) as type
-        UNION
-        MATCH (s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [3]
-        CALL {
-            WITH s
-            MATCH (s)-[r:tag]->(t:TrashType)
-            where not (t.label = "math_count") and not (t.label = "image_noise")
-            return r,t
-        }
-        RETURN distinct toString(id(s)) as source, toString(id(t)) AS target, type(r) as type
-        UNION
-        MATCH (s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [3]
-        RETURN toString(id(status)) as source, toString(status.timestamp.year) AS target, "status_year" as type
-        UNION
         MATCH (s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [3]
-        RETURN toString(id(status)) as source, toString(status.timestamp.month) AS target, "status_month" as type
-        UNION
+        WHERE id(s) IN $skipped
+        WITH min(status.timestamp) as first_skipped
         MATCH (s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [3]
-        RETURN toString(id(status)) as source, toString(status.timestamp.day) AS target, "status_day" as type
-        UNION
-        MATCH (p2:PickUp:LAYER_2)-[r2:contains]->(p:PickUp:LAYER_1)-[r1:report]->(s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [3]
-        CALL {
-            WITH p2
-            MATCH (p2)-[r3:location]->(l:Location)
-            return toString(id(p2)) as source, toString(id(l)) AS target, type(r3) as type
-        }
-        RETURN source, target, type
-        UNION 
-        MATCH (p2:PickUp:LAYER_2)-[r2:contains]->(p:PickUp:LAYER_1)-[r1:report]->(s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [3]
-        RETURN toString(id(p2)) as source, toString(id(p)) AS target, type(r2) as type 
-        UNION 
-        MATCH (p:PickUp:LAYER_1)-[r1:report]->(s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [3]
-        RETURN toString(id(p)) as source, toString(id(s)) AS target, type(r1) as type
-        """)
-    return pd.DataFrame([r.values() for r in result], columns=result.keys())
+        WHERE id(s) IN $scored AND status.timestamp < first_skipped
+        RETURN max(status.timestamp) as last
+        """, {'scored': [int(i) for i in scored_ids], 'skipped': [int(i) for i in skipped_ids]}).single()["last"]
 
 
-def get_validation_triples(tx):
-    result = tx.run(
+def get_prediction_state(tx, tag):
+    record = tx.run(
         """
-        MATCH (s:Report)-[r:status]->(status:Status)
-        RETURN toString(id(s)) as source, toString(id(status)) AS target, type(r) as type
-        UNION
-        MATCH (s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [4]
-        CALL {
-            WITH s
-            MATCH (s)-[r:tag]->(t:TrashType)
-            where not (t.label = "math_count") and not (t.label = "image_noise")
-            return r,t
-        }
-        RETURN distinct toString(id(s)) as source, toString(id(t)) AS target, type(r) as type
-        UNION
-        MATCH (s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [4]
-        RETURN toString(id(status)) as source, toString(status.timestamp.year) AS target, "status_year" as type
-        UNION
-        MATCH (s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [4]
-        RETURN toString(id(status)) as source, toString(status.timestamp.month) AS target, "status_month" as type
-        UNION
-        MATCH (s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [4]
-        RETURN toString(id(status)) as source, toString(status.timestamp.day) AS target, "status_day" as type
-        UNION
-        MATCH (p2:PickUp:LAYER_2)-[r2:contains]->(p:PickUp:LAYER_1)-[r1:report]->(s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [4]
-        CALL {
-            WITH p2
-            MATCH (p2)-[r3:location]->(l:Location)
-            return toString(id(p2)) as source, toString(id(l)) AS target, type(r3) as type
-        }
-        RETURN source, target, type
-        UNION 
-        MATCH (p2:PickUp:LAYER_2)-[r2:contains]->(p:PickUp:LAYER_1)-[r1:report]->(s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [4]
-        RETURN toString(id(p2)) as source, toString(id(p)) AS target, type(r2) as type 
-        UNION 
-        MATCH (p:PickUp:LAYER_1)-[r1:report]->(s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [4]
-        RETURN toString(id(p)) as source, toString(id(s)) AS target, type(r1) as type
-        """)
-    return pd.DataFrame([r.values() for r in result], columns=result.keys())
+        MATCH (p:PredictionState {tag: $tag})
+        RETURN p.last_timestamp as last_timestamp, p.score_cutoff as score_cutoff, p.model_key as model_key
+        """, {'tag': tag}).single()
+    return None if record is None else record.data()
 
 
-def prediction_query(tx):
-    result = tx.run(
+def store_prediction_state(tx, tag, last_timestamp, score_cutoff, model_key):
+    tx.run(
         """
-        MATCH (s:Report)-[:status]->(status:Status)
-        WHERE status.timestamp.month IN [5,6]
-        RETURN toString(id(s)) as id
-        """)
-    return pd.DataFrame([r.values() for r in result], columns=result.keys())
+        MERGE (p:PredictionState {tag: $tag})
+        SET p.last_timestamp = $last_timestamp, p.score_cutoff = $score_cutoff, p.model_key = $model_key
+        """, {'tag': tag, 'last_timestamp': last_timestamp, 'score_cutoff': score_cutoff, 'model_key': model_key})
+
+
+def remove_old_tags(tx, tag, limit=DELETE_CHUNK_SIZE):
+    result = tx.run(
+        f"""
+        MATCH (s:Report)-[x:{tag}]->(t:TrashType)
+        WITH x LIMIT $limit
+        DELETE x
+        RETURN count(*) as deleted
+        """, {'limit': limit})
+    return result.single()['deleted']
 
 
-def remove_old_tags(tx, tag):
+def remove_all_old_tags(session, tag, chunk_size=DELETE_CHUNK_SIZE):
+    # delete in separate transactions of chunk_size edges to bound the transaction memory
+    total = 0
+    while True:
+        with metrics.span("db.remove_old_tags"):
+            deleted = session.execute_write(remove_old_tags, tag, chunk_size)
+        metrics.count("tag_edges_deleted", deleted)
+        total += deleted
+        if deleted < chunk_size:
+            print(f"removed {total} old {tag} edges")
+            return total
+
+
+def remove_report_tags(tx, tag, report_ids):
     tx.run(
         f"""
         MATCH (s:Report)-[x:{tag}]->(t:TrashType)
+        WHERE id(s) IN $ids
         DELETE x
-        """)
+        """, {'ids': report_ids})
+
+
+def remove_all_report_tags(session, tag, report_ids, chunk_size=WRITE_CHUNK_SIZE):
+    for start in range(0, len(report_ids), chunk_size):
+        with metrics.span("db.remove_report_tags"):
+            session.execute_write(remove_report_tags, tag, [int(i) for i in report_ids[start:start + chunk_size]])
 
 
 def get_parents_query(tx):
     result = tx.run(
         """
         MATCH (t:TrashType)
-        RETURN toString(id(t)) as id
+        RETURN id(t) as id
         """)
-    return pd.DataFrame([r.values() for r in result], columns=result.keys())
+    return np.fromiter((record[0] for record in result), dtype=np.int64)
 
 
-def store_candidates(tx, pickup_id, report_ids, tag_name):
-    print(f"pickup id: {pickup_id}")
-    print(f"report ids: {report_ids}")
+def get_neighbour_reports(tx, report_ids, limit=NEIGHBOUR_REPORTS):
+    """
+    Returns the latest other reports of the LAYER_1 pickup of every report, followed by the latest reports of the
+    other pickups of its LAYER_2 cluster, as a dict from report id to at most limit neighbour report ids.
+    """
+    result = tx.run(
+        """
+        UNWIND $ids as report_id
+        MATCH (p1:PickUp:LAYER_1)-[:report]->(r:Report)
+        WHERE id(r) = report_id
+        CALL {
+            WITH p1, r
+            MATCH (p1)-[:report]->(n:Report)-[:status]->(s:Status)
+            WHERE n <> r
+            RETURN n, 1 as priority, s.timestamp as timestamp
+            UNION
+            WITH p1, r
+            MATCH (p2:PickUp:LAYER_2)-[:contains]->(p1)
+            MATCH (p2)-[:contains]->(q1:PickUp:LAYER_1)-[:report]->(n:Report)-[:status]->(s:Status)
+            WHERE q1 <> p1
+            RETURN n, 0 as priority, s.timestamp as timestamp
+        }
+        WITH report_id, n, priority, timestamp
+        ORDER BY priority DESC, timestamp DESC
+        RETURN report_id, collect(id(n))[..$limit] as neighbours
+        """, {'ids': [int(i) for i in report_ids], 'limit': limit})
+    return {record["report_id"]: record["neighbours"] for record in result}
+
+
+def read_neighbour_reports(session, report_ids, chunk_size=NEIGHBOUR_CHUNK_SIZE):
+    neighbours = {}
+    for start in range(0, len(report_ids), chunk_size):
+        with metrics.span("db.get_neighbour_reports"):
+            neighbours.update(session.execute_read(get_neighbour_reports, report_ids[start:start + chunk_size]))
+    return neighbours
+
+
+def store_tag_scores(tx, rows, tag_name):
     tx.run(f"""
-        MATCH (n)
-        WHERE id(n) = toInteger($pickup_id)
-        UNWIND $candidates as ca
-        MATCH (c)
-        WHERE id(c) = toInteger(ca)
-        MERGE (n)-[:{tag_name}]->(c)
-        """, {'pickup_id': pickup_id, 'candidates': report_ids, 'tag_name': tag_name})
+        UNWIND $rows as row
+        MATCH (s)
+        WHERE id(s) = toInteger(row.report)
+        MATCH (t)
+        WHERE id(t) = toInteger(row.trashtype)
+        MERGE (s)-[x:{tag_name}]->(t)
+        SET x.score = row.score, x.variance = row.variance
+        """, {'rows': rows})
+
+
+def write_tag_scores(session, rows, tag_name, chunk_size=WRITE_CHUNK_SIZE):
+    """
+    Writes the predicted tags, rows is a list of dicts with report, trashtype, score and optionally variance,
+    chunk_size rows are written per transaction.
+    """
+    with metrics.span("write_tag_scores") as timer:
+        for start in range(0, len(rows), chunk_size):
+            with metrics.span("db.store_tag_scores"):
+                session.execute_write(store_tag_scores, rows[start:start + chunk_size], tag_name)
+    metrics.count("tag_edges_written", len(rows))
+    metrics.throughput("tag_edges_written", len(rows), timer.seconds)
+    print(f"stored {len(rows)} {tag_name} edges")
 
 
 print(f"Trying to connect to KG at {URI}")
 
 
-def predict_tags(model_path: str, tag_name: str):
-    output = torch.load(model_path)
-    print("model successfully loaded")
-    session_compound = session.execute_read(prediction_query)['id']
-    print("prediction query done")
-    parents = session.execute_read(get_parents_query)['id']
-    session.execute_write(remove_old_tags, tag_name)
-    all_scores = []
-    for i in range(len(session_compound)):
-        df = predict_target(
-            model=output,
-            head=session_compound[i],
-            relation='tag',
-            triples_factory=tf,
-            targets=parents).df
-        print(str(i) + "/" + str(len(session_compound)))
-        all_scores.extend([(session_compound[i], df['tail_label'][j], df['score'][j]) for j in range(len(df))])
-    all_scores = sorted(all_scores, key=lambda x: x[2], reverse=True)
-    # 4.07% of the possible options are actually tagged (in the training data), adjusted for multi-tags (multiple edges to same trash type)
-    all_scores = all_scores[:round(len(all_scores) * 407 / 10000)]
-    for score in all_scores:
-        print(f"predict tag: head: {score[0]} tail: {score[1]} with score: {score[2]}")
-        session.execute_write(store_candidates, score[0], [score[1]], tag_name)
-
-
-def hpo_pairre(training, testing, validation):
-    hpo_pipeline(
-        training=training,
-        testing=testing,
-        validation=validation,
+def _bytes_per_head(model, num_targets):
+    # upper bound for the intermediate tensors of one head, each target is broadcast against the
+    # head/relation representations (e.g. h + r - t for TransE)
+    representations = [*model.entity_representations, *model.relation_representations]
+    dim = max(int(np.prod(representation.shape)) for representation in representations)
+    element_size = next(model.parameters()).element_size()
+    return max(1, num_targets * dim * element_size)
+
+
+def score_tag_batches(model, head_ids, target_ids, relation_id, batch_size=PREDICTION_BATCH_SIZE,
+                      max_memory=PREDICTION_MEMORY_LIMIT):
+    """
+    Scores all (head, relation, target) combinations batch-wise.
+    Yields (offset, scores) where scores is an array of shape (batch, len(target_ids)) for the heads
+    head_ids[offset:offset + batch].
+    """
+    batch_size = max(1, min(batch_size, max_memory // _bytes_per_head(model, len(target_ids))))
+    device = model.device
+    heads = torch.as_tensor(np.asarray(head_ids), dtype=torch.long)
+    targets = torch.as_tensor(np.asarray(target_ids), dtype=torch.long, device=device)
+    for start in range(0, len(heads), batch_size):
+        h = heads[start:start + batch_size].to(device)
+        hr_batch = torch.stack([h, torch.full_like(h, relation_id)], dim=1)
+        # predict_t switches to evaluation mode and disables gradients, like pykeen.predict.predict_target
+        scores = model.predict_t(hr_batch, tails=targets)
+        yield start, scores.detach().cpu().numpy()
+
+
+def score_tags(model, head_ids, target_ids, relation_id, batch_size=PREDICTION_BATCH_SIZE,
+               max_memory=PREDICTION_MEMORY_LIMIT):
+    """
+    Scores all (head, relation, target) combinations, returns an array of shape (len(head_ids), len(target_ids)).
+    """
+    scores = np.empty((len(head_ids), len(target_ids)), dtype=np.float32)
+    for start, batch in score_tag_batches(model, head_ids, target_ids, relation_id, batch_size, max_memory):
+        scores[start:start + len(batch)] = batch
+    return scores
+
+
+def score_ensemble_batches(models, head_ids, target_ids, relation_id, batch_size=PREDICTION_BATCH_SIZE,
+                           max_memory=PREDICTION_MEMORY_LIMIT):
+    """
+    Like score_tag_batches for several models in one pass, the yielded scores have the shape
+    (len(models), batch, len(target_ids)).
+    """
+    batch_size = max(1, min([batch_size] + [max_memory // _bytes_per_head(model, len(target_ids)) for model in models]))
+    generators = [score_tag_batches(model, head_ids, target_ids, relation_id, batch_size, max_memory)
+                  for model in models]
+    for batches in zip(*generators):
+        yield batches[0][0], np.stack([scores for _, scores in batches])
+
+
+def score_neighbour_means(models, snapshot, neighbours, target_ids, relation_id):
+    """
+    Scores reports that are unknown to the models (the embeddings are transductive) by the mean scores of their
+    neighbour reports that are part of the snapshot, neighbours maps report ids to the ids of their neighbour reports.
+    Returns the ids of the reports with known neighbours and their scores, an array of shape
+    (len(models), len(ids), len(target_ids)).
+    """
+    members = {}
+    for report, neighbour_ids in neighbours.items():
+        entity_ids = map_entities(snapshot, neighbour_ids)
+        if (entity_ids >= 0).any():
+            members[int(report)] = entity_ids[entity_ids >= 0]
+    report_ids = np.fromiter(members, dtype=np.int64, count=len(members))
+    if not members:
+        return report_ids, np.empty((len(models), 0, len(target_ids)), dtype=np.float32)
+    counts = np.array([len(entity_ids) for entity_ids in members.values()])
+    unique, inverse = np.unique(np.concatenate(list(members.values())), return_inverse=True)
+    scores = np.empty((len(models), len(unique), len(target_ids)), dtype=np.float32)
+    for start, batch in score_ensemble_batches(models, unique, target_ids, relation_id):
+        scores[:, start:start + batch.shape[1]] = batch
+    sums = np.add.reduceat(scores[:, inverse], np.cumsum(counts) - counts, axis=1)
+    return report_ids, sums / counts[None, :, None]
+
+
+class TopScoreSelector:
+    """
+    Selects the best scores from (offset, scores) batches without keeping the full score matrix in memory. Only the
+    global top fraction of all `total` scores is kept, optionally restricted to the best per_report_k targets per
+    head and to scores >= threshold.
+    """
+
+    def __init__(self, total, fraction=TAG_FRACTION, per_report_k=None, threshold=None):
+        self.k = None if fraction is None else round(total * fraction)
+        self.per_report_k = per_report_k
+        self.threshold = threshold
+        self.heads = np.empty(0, dtype=np.int64)
+        self.targets = np.empty(0, dtype=np.int64)
+        self.scores = np.empty(0, dtype=np.float32)
+        self.extra = np.empty(0, dtype=np.float32)
+
+    def add(self, offset, batch, extra=None):
+        """
+        Adds the scores of the heads offset..offset + len(batch), extra is an optional array of the same shape
+        whose values are kept along with the selected scores.
+        """
+        if self.per_report_k is not None and self.per_report_k < batch.shape[1]:
+            cols = np.argpartition(-batch, self.per_report_k - 1, axis=1)[:, :self.per_report_k].ravel()
+            rows = np.repeat(np.arange(len(batch)), self.per_report_k)
+        else:
+            rows, cols = (index.ravel() for index in np.indices(batch.shape))
+        values = batch[rows, cols]
+        extra = np.full(len(values), np.nan, dtype=np.float32) if extra is None else extra[rows, cols]
+        if self.threshold is not None:
+            mask = values >= self.threshold
+            rows, cols, values, extra = rows[mask], cols[mask], values[mask], extra[mask]
+        self.heads = np.concatenate([self.heads, rows + offset])
+        self.targets = np.concatenate([self.targets, cols])
+        self.scores = np.concatenate([self.scores, values])
+        self.extra = np.concatenate([self.extra, extra])
+        # bounded candidate set: only the k best scores seen so far can be part of the result
+        if self.k is not None and len(self.scores) > self.k:
+            keep = np.argpartition(-self.scores, self.k - 1)[:self.k] if self.k > 0 else np.empty(0, dtype=np.int64)
+            self.heads, self.targets = self.heads[keep], self.targets[keep]
+            self.scores, self.extra = self.scores[keep], self.extra[keep]
+
+    def result(self):
+        """
+        Returns the arrays (head_index, target_index, score, extra) sorted by descending score.
+        """
+        order = np.argsort(-self.scores, kind="stable")
+        return self.heads[order], self.targets[order], self.scores[order], self.extra[order]
+
+
+def select_top_scores(score_batches, total, fraction=TAG_FRACTION, per_report_k=None, threshold=None):
+    """
+    Selects the best scores from the (offset, scores) batches of score_tag_batches without keeping the full
+    score matrix in memory. Only the global top fraction of all `total` scores is kept, optionally restricted to
+    the best per_report_k targets per head and to scores >= threshold.
+    Returns the arrays (head_index, target_index, score) sorted by descending score.
+    """
+    selector = TopScoreSelector(total, fraction, per_report_k, threshold)
+    for offset, batch in score_batches:
+        selector.add(offset, batch)
+    heads, targets, scores, _ = selector.result()
+    return heads, targets, scores
+
+
+def _tag_rows(reports, parents, heads, targets, scores, variances=None):
+    rows = [{'report': int(reports[head]), 'trashtype': int(parents[target]), 'score': float(score)}
+            for head, target, score in zip(heads, targets, scores)]
+    if variances is not None:
+        for row, variance in zip(rows, variances):
+            row['variance'] = float(variance)
+    return rows
+
+
+def last_prediction_timestamp(tags):
+    """
+    Returns the earliest last processed Status timestamp of the prediction states of the tags, None if a tag has none.
+    """
+    with metrics.span("db.get_prediction_state"):
+        states = [session.execute_read(get_prediction_state, tag) for tag in tags]
+    if any(state is None or state["last_timestamp"] is None for state in states):
+        return None
+    return min(state["last_timestamp"] for state in states)
+
+
+def predict_tags(models, snapshot, tag_names, aggregate_tag_name=None, model_key=None, incremental=False, since=None,
+                 fraction=TAG_FRACTION, per_report_k=TAGS_PER_REPORT, threshold=TAG_SCORE_THRESHOLD):
+    """
+    Scores the reports with all models in one batched pass and writes the top tags of every model to its tag name.
+    With aggregate_tag_name, the top tags by the mean score over all models are written as well, storing the mean
+    as score and the variance over the models.
+    Every tag name keeps a prediction state in the KG: the last processed Status timestamp, the score of the weakest
+    selected tag (the cutoff of the global top fraction) and the model_key of the models. In incremental mode only
+    the reports newer than the last processed timestamp are scored, and their tags are selected by the stored cutoff
+    instead of the top fraction. Without a state of the same models, all reports are predicted. With since, the
+    reports newer than since are predicted by the top fraction.
+    Reports unknown to the models (created after their snapshot) are scored by the mean scores of their neighbour
+    reports, see score_neighbour_means. Reports without known neighbours are skipped when predicting the reports
+    newer than a timestamp (the stored timestamp stays before the first of them). Returns False without writing
+    anything if the models have to be retrained on a newer snapshot: trash types are unknown, or reports without
+    known neighbours when predicting all reports. Returns True otherwise.
+    """
+    all_tags = tag_names + ([aggregate_tag_name] if aggregate_tag_name else [])
+    states = {}
+    if incremental:
+        with metrics.span("db.get_prediction_state"):
+            states = {tag: session.execute_read(get_prediction_state, tag) for tag in all_tags}
+        if any(state is None or state["score_cutoff"] is None or state["model_key"] != model_key
+               for state in states.values()):
+            print("no prediction state of these models for all tags, predicting all reports")
+            incremental = False
+        else:
+            since = min(state["last_timestamp"] for state in states.values())
+    with metrics.span("db.prediction_query"):
+        session_compound, last_timestamp = session.execute_read(prediction_query, since)
+    metrics.count("reports_read", len(session_compound))
+    print(f"prediction query done, {len(session_compound)} reports")
+    if len(session_compound) == 0:
+        return True
+    with metrics.span("db.get_parents"):
+        parents = session.execute_read(get_parents_query)
+    head_ids = map_entities(snapshot, session_compound)
+    target_ids = map_entities(snapshot, parents)
+    if (target_ids < 0).any():
+        print(f"{(target_ids < 0).sum()} trash types are unknown to the models")
+        return False
+    tag_relation = relation_id(snapshot, 'tag')
+    reports = session_compound[head_ids >= 0]
+    inductive_ids, inductive_scores = np.empty(0, dtype=np.int64), None
+    if (head_ids < 0).any():
+        unknown = session_compound[head_ids < 0]
+        neighbours = read_neighbour_reports(session, unknown)
+        with metrics.span("scoring_neighbours"):
+            inductive_ids, inductive_scores = score_neighbour_means(models, snapshot, neighbours, target_ids,
+                                                                    tag_relation)
+        metrics.count("reports_inductive", len(inductive_ids))
+        print(f"scoring {len(inductive_ids)} of {len(unknown)} reports unknown to the models by their neighbours")
+        skipped = np.setdiff1d(unknown, inductive_ids)
+        if len(skipped):
+            if since is None:
+                print(f"{len(skipped)} reports have no neighbour reports known to the models")
+                return False
+            print(f"WARNING: skipping {len(skipped)} reports without neighbour reports known to the models, "
+                  f"they are tagged after the next retraining")
+            with metrics.span("db.get_high_water_mark"):
+                last_timestamp = session.execute_read(get_high_water_mark, np.concatenate([reports, inductive_ids]),
+                                                      skipped)
+            if last_timestamp is None:
+                last_timestamp = since
+    total = (len(reports) + len(inductive_ids)) * len(target_ids)
+
+    def selector(tag):
+        if not incremental:
+            return TopScoreSelector(total, fraction, per_report_k, threshold)
+        cutoff = states[tag]["score_cutoff"]
+        return TopScoreSelector(total, None, per_report_k, cutoff if threshold is None else max(threshold, cutoff))
+
+    selectors = {tag: selector(tag) for tag in all_tags}
+
+    def add_scores(offset, scores):
+        for tag_name, model_scores in zip(tag_names, scores):
+            selectors[tag_name].add(offset, model_scores)
+        if aggregate_tag_name:
+            selectors[aggregate_tag_name].add(offset, scores.mean(axis=0), scores.var(axis=0))
+
+    with metrics.span("scoring") as timer, metrics.profiled("predict_tags"):
+        for offset, scores in score_ensemble_batches(models, map_entities(snapshot, reports), target_ids,
+                                                     tag_relation):
+            add_scores(offset, scores)
+    if inductive_scores is not None:
+        # the reports scored by their neighbours follow the known reports
+        add_scores(len(reports), inductive_scores)
+        reports = np.concatenate([reports, inductive_ids])
+    metrics.count("scores_computed", len(reports) * len(target_ids) * len(models))
+    metrics.throughput("scores_computed", len(reports) * len(target_ids) * len(models), timer.seconds)
+    for tag_name in all_tags:
+        heads, targets, scores, variances = selectors[tag_name].result()
+        print(f"selected {len(scores)} of {total} {tag_name} candidates")
+        if since is not None:
+            remove_all_report_tags(session, tag_name, reports)
+        else:
+            remove_all_old_tags(session, tag_name)
+        cutoff = states[tag_name]["score_cutoff"] if incremental else (float(scores[-1]) if len(scores) else None)
+        rows = _tag_rows(reports, parents, heads, targets, scores,
+                         variances if tag_name == aggregate_tag_name else None)
+        write_tag_scores(session, rows, tag_name)
+        with metrics.span("db.store_prediction_state"):
+            session.execute_write(store_prediction_state, tag_name, last_timestamp, cutoff, model_key)
+    return True
+
+
+def _init_training_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def _train_replica(name, training, testing, validation, random_seed, hpo_config, fingerprint, directory):
+    output = train_model(name, training, testing, validation, random_seed, hpo_config)
+    save_model(output, directory, name, random_seed, hpo_config, fingerprint)
+    return directory
+
+
+def train_ensemble(name, training, testing, validation, tag_names, fingerprint, hpo_config=None, reuse=False,
+                   workers=ENSEMBLE_WORKERS, threads_per_worker=THREADS_PER_WORKER, seed=ENSEMBLE_SEED):
+    """
+    Trains one model of TRAINING_CONFIGS[name] per tag name in a pool of worker processes, the replicas use the seeds
+    seed, seed + 1, ... With reuse, replicas whose stored model matches the configuration and triple snapshot are
+    not trained again. Returns the model directories.
+    """
+    directories = [f"result_{tag_name}" for tag_name in tag_names]
+    seeds = [seed + i for i in range(len(tag_names))]
+    missing = [i for i in range(len(tag_names))
+               if not reuse or not is_cached_model(directories[i], name, seeds[i], hpo_config, fingerprint)]
+    print(f"reusing {len(tag_names) - len(missing)} trained models, training {len(missing)}")
+    metrics.count("models_trained", len(missing))
+    if missing:
+        with metrics.span("training"):
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"),
+                                     initializer=_init_training_worker, initargs=(threads_per_worker,)) as executor:
+                futures = [executor.submit(_train_replica, name, training, testing, validation, seeds[i],
+                                           hpo_config, fingerprint, directories[i])
+                           for i in missing]
+                for future in futures:
+                    future.result()
+    return directories
+
+
+def export_embeddings(model, snapshot, directory, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Writes the entity and relation embeddings of a model chunk-wise to memory-mapped .npy files, together with the
+    graph ids of the entities, the relation labels and the members of the EMBEDDING_GROUPS.
+    """
+    os.makedirs(directory, exist_ok=True)
+    # indices of previously exported embeddings are stale
+    for file in os.listdir(directory):
+        if file.startswith("index_"):
+            os.remove(os.path.join(directory, file))
+    model.eval()
+    for kind, representations in (("entity", model.entity_representations),
+                                  ("relation", model.relation_representations)):
+        for i, representation in enumerate(representations):
+            count, dim = representation.max_id, int(np.prod(representation.shape))
+            name = f"{kind}_embeddings.npy" if i == 0 else f"{kind}_embeddings_{i}.npy"
+            embeddings = np.lib.format.open_memmap(os.path.join(directory, name), mode="w+", dtype=np.float32,
+                                                   shape=(count, dim))
+            with torch.inference_mode():
+                for start in range(0, count, chunk_size):
+                    indices = torch.arange(start, min(start + chunk_size, count), device=model.device)
+                    embeddings[start:start + len(indices)] = (
+                        representation(indices=indices).reshape(len(indices), -1).float().cpu().numpy())
+            embeddings.flush()
+    np.save(os.path.join(directory, "entity_ids.npy"), np.asarray(snapshot["entity_ids"]))
+    np.save(os.path.join(directory, "relation_labels.npy"), np.asarray(snapshot["relation_labels"]))
+    triples = np.asarray(snapshot["triples"])
+    for group, (relation, position) in EMBEDDING_GROUPS.items():
+        if relation not in snapshot["relation_labels"]:
+            continue
+        members = np.unique(triples[triples[:, 1] == relation_id(snapshot, relation), position])
+        np.save(os.path.join(directory, f"group_{group}.npy"), members)
+    print(f"exported {model.num_entities} entity embeddings to {directory}")
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux, the training runs in worker processes
+    return dict(peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                peak_rss_children_mb=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+
+def evaluate_ranking(model, training, testing, validation, hits_at=BENCHMARK_HITS_AT):
+    """
+    Filtered link prediction metrics of the testing triples (training and validation triples are filtered).
+    """
+    result = RankBasedEvaluator().evaluate(model, testing.mapped_triples,
+                                           additional_filter_triples=[training.mapped_triples,
+                                                                      validation.mapped_triples])
+    ranking = dict(mrr=result.get_metric("inverse_harmonic_mean_rank"))
+    for k in hits_at:
+        ranking[f"hits_at_{k}"] = result.get_metric(f"hits_at_{k}")
+    return ranking
+
+
+def evaluate_tag_prediction(model, snapshot, testing, fraction=TAG_FRACTION):
+    """
+    Precision and recall of the tags predicted (like predict_tags) for the reports of the TESTING_MONTHS, against
+    their tags in the testing triples, and the scoring throughput.
+    """
+    tag = relation_id(snapshot, "tag")
+    triples = np.asarray(snapshot["triples"])
+    month = np.asarray(snapshot["month"])
+    reports = np.unique(triples[(triples[:, 1] == relation_id(snapshot, "status")) & np.isin(month, TESTING_MONTHS), 0])
+    trash_types = np.unique(triples[triples[:, 1] == tag, 2])
+    test_tags = testing.mapped_triples.numpy()
+    test_tags = test_tags[test_tags[:, 1] == tag]
+    truth = set(zip(test_tags[:, 0].tolist(), test_tags[:, 2].tolist()))
+    ts = time.time()
+    heads, targets, _ = select_top_scores(score_tag_batches(model, reports, trash_types, tag),
+                                          len(reports) * len(trash_types), fraction)
+    seconds = time.time() - ts
+    selected = set(zip(reports[heads].tolist(), trash_types[targets].tolist()))
+    hits = len(selected & truth)
+    return dict(
+        tag_precision=hits / len(selected) if selected else 0.0,
+        tag_recall=hits / len(truth) if truth else 0.0,
+        scored_reports=len(reports),
+        scoring_reports_per_second=len(reports) / seconds if seconds > 0 else None,
+    )
+
+
+def run_benchmark(training, testing, validation, snapshot, fingerprint, names=BENCHMARK_MODELS,
+                  output_file=BENCHMARK_FILE, reuse=BENCHMARK_REUSE_MODELS):
+    """
+    Trains (or reuses) one model per name on the triple snapshot and appends its quality and performance
+    measurements to output_file.
+    """
+    for name in names:
+        hpo_config = load_hpo_config(name) if USE_HPO_CONFIG else None
+        directory, = train_ensemble(name, training, testing, validation, [f"BENCHMARK_{name.upper()}"], fingerprint,
+                                    hpo_config, reuse, workers=1, threads_per_worker=os.cpu_count() or 1)
+        meta = _model_meta(directory)
+        model = load_model(directory, training)
+        result = dict(
+            model=name,
+            snapshot=fingerprint,
+            config_hash=meta["config_hash"],
+            timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+            device=str(model.device),
+            train_seconds=meta.get("train_seconds"),
+            training_triples_per_second=(meta["num_training_triples"] * meta["num_epochs"] / meta["train_seconds"]
+                                         if meta.get("train_seconds") else None),
+            **evaluate_ranking(model, training, testing, validation),
+            **evaluate_tag_prediction(model, snapshot, testing),
+            **_peak_rss_mb(),
+        )
+        if torch.cuda.is_available():
+            result["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 1024 ** 2
+        print(result)
+        with open(output_file, "a") as file:
+            file.write(json.dumps(result) + "\n")
+
+
+HPO_CONFIGS = {
+    "pairre": dict(
         model='PairRE',
         n_trials=1000,
         stopper='early',
@@ -283,27 +912,15 @@ def hpo_pairre(training, testing, validation):
         # epochs=1,
         # dimensions=512,
         model_kwargs=dict(random_seed=1000),
-    )
-
-
-def hpo_transe(training, testing, validation):
-    hpo_pipeline(
-        training=training,
-        testing=testing,
-        validation=validation,
+    ),
+    "transe": dict(
         model='TransE',
         n_trials=1000,
         stopper='early',
         stopper_kwargs=dict(frequency=10, patience=2, relative_delta=0.01),
         model_kwargs=dict(random_seed=1000),
-    )
-
-
-def hpo_tucker(training, testing, validation):
-    hpo_pipeline(
-        training=training,
-        testing=testing,
-        validation=validation,
+    ),
+    "tucker": dict(
         model='TuckER',
         n_trials=4000,
         stopper='early',
@@ -315,28 +932,95 @@ def hpo_tucker(training, testing, validation):
             num_negs_per_pos=dict(type=int, low=1, high=19, log=True),
         ),
         model_kwargs=dict(random_seed=1000),
-    )
+    ),
+}
 
 
-def training_transe(training, testing, validation):
-    return pipeline(
+def _hpo_storage(url):
+    # the heartbeat marks trials of crashed workers as failed, so that resumed studies don't wait for them
+    return optuna.storages.RDBStorage(url, heartbeat_interval=60, grace_period=180,
+                                      engine_kwargs=dict(connect_args=dict(timeout=60)))
+
+
+def _hpo_worker(config, study_name, storage, n_trials, training, testing, validation):
+    config = {key: value for key, value in config.items() if key != "n_trials"}
+    return hpo_pipeline(
         training=training,
         testing=testing,
         validation=validation,
+        storage=_hpo_storage(storage),
+        study_name=study_name,
+        load_if_exists=True,
+        n_trials=n_trials,
+        pruner=HPO_PRUNER,
+        pruner_kwargs=HPO_PRUNER_KWARGS,
+        **config,
+    )
+
+
+def run_hpo(name, training, testing, validation, workers=HPO_WORKERS, storage=HPO_STORAGE):
+    """
+    Runs the hyperparameter optimization of HPO_CONFIGS[name] in worker processes sharing one persistent study,
+    an interrupted study is resumed with the remaining number of trials. The best pipeline configuration is exported
+    to HPO_RESULTS_DIR/name.
+    """
+    study_name = f"hpo_{name}"
+    study = optuna.create_study(study_name=study_name, storage=_hpo_storage(storage), direction="maximize",
+                                load_if_exists=True)
+    # failed trials (including those of crashed workers) don't count towards n_trials
+    finished = len(study.get_trials(deepcopy=False, states=(TrialState.COMPLETE, TrialState.PRUNED)))
+    remaining = max(0, HPO_CONFIGS[name]["n_trials"] - finished)
+    print(f"study {study_name}: {finished} completed or pruned trials, running {remaining} more in {workers} workers")
+    trials_per_worker = [remaining // workers + (i < remaining % workers) for i in range(workers)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"),
+                             initializer=_init_training_worker,
+                             initargs=(max(1, (os.cpu_count() or 1) // workers),)) as executor:
+        futures = [executor.submit(_hpo_worker, HPO_CONFIGS[name], study_name, storage, n_trials, training, testing,
+                                   validation)
+                   for n_trials in trials_per_worker if n_trials > 0]
+        for future in futures:
+            future.result()
+    # no further trials, only collect the study result
+    result = _hpo_worker(HPO_CONFIGS[name], study_name, storage, 0, training, testing, validation)
+    result.save_to_directory(os.path.join(HPO_RESULTS_DIR, name))
+    print(f"best {name} trial: {study.best_trial.number} with {study.best_value}")
+
+
+def load_hpo_config(name):
+    with open(os.path.join(HPO_RESULTS_DIR, name, "best_pipeline", "pipeline_config.json")) as file:
+        return json.load(file)["pipeline"]
+
+
+def with_hpo_config(config, hpo_config=None):
+    """
+    Overrides the components and kwargs of a pipeline configuration with those of an exported HPO configuration.
+    """
+    if not hpo_config:
+        return config
+    config = dict(config)
+    for key in ("loss", "optimizer", "negative_sampler", "regularizer", "lr_scheduler"):
+        if key in hpo_config:
+            config[key] = hpo_config[key]
+        key = f"{key}_kwargs"
+        if key in hpo_config:
+            config[key] = {**config.get(key, {}), **hpo_config[key]}
+    # the fixed model seed of the HPO would give all ensemble replicas the same initialization
+    config["model_kwargs"] = {**config.get("model_kwargs", {}), **{
+        key: value for key, value in hpo_config.get("model_kwargs", {}).items() if key != "random_seed"}}
+    config["training_kwargs"] = {**config.get("training_kwargs", {}), **hpo_config.get("training_kwargs", {})}
+    return config
+
+
+TRAINING_CONFIGS = {
+    "transe": dict(
         model='TransE',
         model_kwargs=dict(embedding_dim=80, scoring_fct_norm=1),
         loss_kwargs=dict(margin=2.814806827125555),
         optimizer_kwargs=dict(lr=0.008058540259651512),
         negative_sampler_kwargs=dict(num_negs_per_pos=86),
         training_kwargs=dict(num_epochs=100, batch_size=4096),
-    )
-
-
-def training_pairre(training, testing, validation):
-    return pipeline(
-        training=training,
-        testing=testing,
-        validation=validation,
+    ),
+    "pairre": dict(
         model='PairRE',
         model_kwargs=dict(embedding_dim=256, p=1),
         loss='NSSA',
@@ -344,22 +1028,98 @@ def training_pairre(training, testing, validation):
         optimizer_kwargs=dict(lr=0.06565888227),
         negative_sampler_kwargs=dict(num_negs_per_pos=29),
         training_kwargs=dict(num_epochs=400, batch_size=2048),
-    )
+    ),
+    "tucker": dict(
+        model='TuckER',
+        model_kwargs=dict(embedding_dim=224, relation_dim=16, dropout_0=0.2, dropout_1=0.0, dropout_2=0.1),
+        optimizer_kwargs=dict(lr=0.0012459322629918364),
+        negative_sampler_kwargs=dict(num_negs_per_pos=12),
+        training_kwargs=dict(num_epochs=500, batch_size=219),
+    ),
+}
 
 
-def training_tucker():
+def train_model(name, training, testing, validation, random_seed=None, hpo_config=None):
     return pipeline(
         training=training,
         testing=testing,
         validation=validation,
-        model='TuckER',
-        model_kwargs=dict(embedding_dim=224, relation_dim=16, dropout_0=0.2, dropout_1=0.0, dropout_2=0.1),
-        optimizer_kwargs=dict(lr=0.0012459322629918364),
-        negative_sampler_kwargs=dict(num_negs_per_pos=12),
-        training_kwargs=dict(num_epochs=500, batch_size=219),
+        random_seed=random_seed,
+        **with_hpo_config(TRAINING_CONFIGS[name], hpo_config),
     )
 
 
+def config_hash(name, random_seed, hpo_config=None):
+    config = dict(config=with_hpo_config(TRAINING_CONFIGS[name], hpo_config), random_seed=random_seed)
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def save_model(output, directory, name, random_seed, hpo_config, fingerprint):
+    """
+    Saves the pipeline result and additionally the plain model weights with the metadata needed to rebuild the model
+    without unpickling it.
+    """
+    output.save_to_directory(directory)
+    torch.save(output.model.state_dict(), os.path.join(directory, "model_state.pt"))
+    with open(os.path.join(directory, "model_meta.json"), "w") as file:
+        json.dump({
+            "name": name,
+            "config": with_hpo_config(TRAINING_CONFIGS[name], hpo_config),
+            "config_hash": config_hash(name, random_seed, hpo_config),
+            "snapshot": fingerprint,
+            "num_entities": output.model.num_entities,
+            "num_relations": output.model.num_relations,
+            "num_training_triples": output.training.num_triples,
+            "num_epochs": len(output.losses),
+            "train_seconds": output.train_seconds,
+        }, file, indent=2, default=str)
+
+
+def _model_meta(directory):
+    path = os.path.join(directory, "model_meta.json")
+    if not os.path.exists(path) or not os.path.exists(os.path.join(directory, "model_state.pt")):
+        return None
+    with open(path) as file:
+        return json.load(file)
+
+
+def is_cached_model(directory, name, random_seed, hpo_config, fingerprint):
+    meta = _model_meta(directory)
+    return (meta is not None and meta["config_hash"] == config_hash(name, random_seed, hpo_config)
+            and meta["snapshot"] == fingerprint)
+
+
+def cached_ensemble_fingerprint(name, tag_names, hpo_config=None, seed=ENSEMBLE_SEED):
+    """
+    Returns the snapshot fingerprint of the stored replicas if all of them match the configuration and were trained
+    on the same, still cached snapshot, otherwise None.
+    """
+    metas = [_model_meta(f"result_{tag_name}") for tag_name in tag_names]
+    if any(meta is None or meta["config_hash"] != config_hash(name, seed + i, hpo_config)
+           for i, meta in enumerate(metas)):
+        return None
+    fingerprints = {meta["snapshot"] for meta in metas}
+    if len(fingerprints) != 1 or not os.path.isdir(os.path.join(TRIPLE_CACHE_DIR, *fingerprints)):
+        return None
+    return fingerprints.pop()
+
+
+def load_model(directory, triples_factory, device=None):
+    """
+    Rebuilds the model of a directory written by save_model and loads its weights (memory-mapped if supported by
+    torch) instead of unpickling the whole model.
+    """
+    meta = _model_meta(directory)
+    device = resolve_device(device)
+    model = model_resolver.make(meta["config"]["model"], meta["config"].get("model_kwargs"),
+                                triples_factory=triples_factory)
+    load_kwargs = dict(map_location=device, weights_only=True)
+    if "mmap" in inspect.signature(torch.load).parameters:
+        load_kwargs["mmap"] = True
+    model.load_state_dict(torch.load(os.path.join(directory, "model_state.pt"), **load_kwargs))
+    return model.to(device)
+
+
 if __name__ == "__main__":
     """
     This script is used to train a model on the KG and predict tags for the reports.
@@ -367,9 +1127,22 @@ if __name__ == "__main__":
     - hpo-transe: to run hyperparameter optimization for TransE
     - hpo-pairre: to run hyperparameter optimization for PairRE
     - hpo-tucker: to run hyperparameter optimization for TuckER
+    (an interrupted optimization is resumed from HPO_STORAGE, set USE_HPO_CONFIG to train with its best configuration)
     - predict-transe: to predict tags using the TransE model
     - predict-pairre: to predict tags using the PairRE model
     - predict-tucker: to predict tags using the TuckER model
+    - predict-only-transe / predict-only-pairre / predict-only-tucker: to predict tags reusing the trained models of
+      a previous run if they match the configuration and the triple snapshot
+    - predict-incremental-transe / predict-incremental-pairre / predict-incremental-tucker: to predict tags only for
+      the reports newer than the last prediction, using the same models (new reports are scored from the reports of
+      their pickup)
+    - benchmark: to measure link prediction and tag prediction quality, training and scoring throughput and peak
+      memory of the BENCHMARK_MODELS, appended to BENCHMARK_FILE
+    - export-transe / export-pairre / export-tucker: to export the embeddings of the first (trained or reused)
+      replica to embeddings_<model> and build the nearest-neighbour indices, see embedding_index.py
+    - serve-transe / serve-pairre / serve-tucker: to keep the (trained or reused) ensemble in memory and answer tag
+      predictions of single reports over HTTP, reports newer than the snapshot are scored from the reports of their
+      pickup, see scoring_service.py
     """
     COMMAND = "hpo-transe"
 
@@ -377,58 +1150,99 @@ if __name__ == "__main__":
         driver.verify_connectivity()
 
         print("Connection successful")
-        session = driver.session()
-
-        triples = session.execute_read(get_triples)
-        print("fetched triples")
-        training_triples = session.execute_read(get_training_triples)
-        test_triples = session.execute_read(get_test_triples)
-        validation_triples = session.execute_read(get_validation_triples)
-        tf = TriplesFactory.from_labeled_triples(
-            triples[["source", "type", "target"]].values
-        )
-        # get spo triples from the graph
-        print("get spo triples from graph")
+        session = driver.session(fetch_size=FETCH_SIZE)
 
-        training = TriplesFactory.from_labeled_triples(
-            training_triples[["source", "type", "target"]].values,
-            entity_to_id=tf.entity_to_id,
-            relation_to_id=tf.relation_to_id
-        )
-        testing = TriplesFactory.from_labeled_triples(
-            test_triples[["source", "type", "target"]].values,
-            entity_to_id=tf.entity_to_id,
-            relation_to_id=tf.relation_to_id
-        )
-        validation = TriplesFactory.from_labeled_triples(
-            validation_triples[["source", "type", "target"]].values,
-            entity_to_id=tf.entity_to_id,
-            relation_to_id=tf.relation_to_id
-        )
+        # get spo triples from the graph or the local snapshot
+        with metrics.span("load_triples"):
+            fingerprint, snapshot = load_triples(session)
+        with metrics.span("split_triples"):
+            tf, training, testing, validation = split_triples(snapshot)
+        print("split triples into training, testing and validation")
+
+        if COMMAND.startswith("hpo-"):
+            with metrics.span("hpo"):
+                run_hpo(COMMAND[len("hpo-"):], training, testing, validation)
 
+        if COMMAND == "benchmark":
+            with metrics.span("benchmark"):
+                run_benchmark(training, testing, validation, snapshot, fingerprint)
 
-        if COMMAND == "hpo-transe":
-            hpo_transe(training, testing, validation)
-        elif COMMAND == "hpo-pairre":
-            hpo_pairre(training, testing, validation)
-        elif COMMAND == "hpo-tucker":
-            hpo_tucker(training, testing, validation)
-        elif COMMAND == "predict-transe":
-            training_method = training_transe
-            tag_prefix = "PREDICTED_TAGS_TRANSE_"
-        elif COMMAND == "predict-pairre":
-            training_method = training_pairre
-            tag_prefix = "PREDICTED_TAGS_PAIRRE_"
-        elif COMMAND == "predict-tucker":
-            training_method = training_tucker
-            tag_prefix = "PREDICTED_TAGS_TUCKER_"
+        if COMMAND.startswith("export-"):
+            model_name = COMMAND[len("export-"):]
+            hpo_config = load_hpo_config(model_name) if USE_HPO_CONFIG else None
+            directory, = train_ensemble(model_name, training, testing, validation,
+                                        [f"PREDICTED_TAGS_{model_name.upper()}_0"], fingerprint, hpo_config, True)
+            with metrics.span("export_embeddings"):
+                export_embeddings(load_model(directory, training), snapshot, f"embeddings_{model_name}")
+            with metrics.span("build_index"):
+                for group in INDEXED_GROUPS:
+                    build_index(f"embeddings_{model_name}", group)
 
         if COMMAND.startswith("predict-"):
-            for tag_postfix in range(10):
-                ts = time.time()
-                tag_name = tag_prefix + str(tag_postfix)
-                output = training_method(training, testing, validation)
-                output.save_to_directory(f'result_{tag_name}')
-                print(f"loading model from result_{tag_name}/trained_model.pkl")
-                predict_tags(f"result_{tag_name}/trained_model.pkl", tag_name)
-                print(f"Time for tag {tag_postfix}: {time.time() - ts}")
+            model_name = COMMAND.split("-")[-1]
+            incremental = COMMAND.startswith("predict-incremental-")
+            tag_prefix = f"PREDICTED_TAGS_{model_name.upper()}_"
+            hpo_config = load_hpo_config(model_name) if USE_HPO_CONFIG else None
+            ts = time.time()
+            tag_names = [tag_prefix + str(tag_postfix) for tag_postfix in range(ENSEMBLE_SIZE)]
+            # an increment has to be scored by the same models (and thus snapshot) as the previous prediction
+            model_fingerprint = cached_ensemble_fingerprint(model_name, tag_names, hpo_config) if incremental else None
+            if model_fingerprint is not None:
+                model_snapshot = load_snapshot(os.path.join(TRIPLE_CACHE_DIR, model_fingerprint))
+                model_training = split_triples(model_snapshot)[1]
+                directories = [f"result_{tag_name}" for tag_name in tag_names]
+            else:
+                model_fingerprint, model_snapshot, model_training = fingerprint, snapshot, training
+                reuse = COMMAND.startswith(("predict-only-", "predict-incremental-"))
+                directories = train_ensemble(model_name, training, testing, validation, tag_names, fingerprint,
+                                             hpo_config, reuse)
+            with metrics.span("load_models"):
+                models = [load_model(directory, model_training) for directory in directories]
+            model_key = model_fingerprint + ":" + ",".join(_model_meta(directory)["config_hash"]
+                                                           for directory in directories)
+            print(f"Time for training/loading {len(models)} models: {time.time() - ts}")
+            ts = time.time()
+            with metrics.span("predict_tags"):
+                # retraining can only help if the models were trained on an older snapshot than the current one
+                predicted = predict_tags(models, model_snapshot, tag_names, tag_prefix + "MEAN", model_key,
+                                         incremental)
+            if not predicted:
+                # only the tags of the reports after the last prediction are replaced, by the new models
+                since = last_prediction_timestamp(tag_names + [tag_prefix + "MEAN"]) if incremental else None
+                print(f"WARNING: the models don't know the current graph, retraining {len(tag_names)} models and "
+                      + ("predicting all reports" if since is None else f"predicting the reports newer than {since}"))
+                directories = train_ensemble(model_name, training, testing, validation, tag_names, fingerprint,
+                                             hpo_config, True)
+                with metrics.span("load_models"):
+                    models = [load_model(directory, training) for directory in directories]
+                model_key = fingerprint + ":" + ",".join(_model_meta(directory)["config_hash"]
+                                                         for directory in directories)
+                with metrics.span("predict_tags"):
+                    predict_tags(models, snapshot, tag_names, tag_prefix + "MEAN", model_key, since=since)
+            print(f"Time for predicting tags: {time.time() - ts}")
+
+        if COMMAND.startswith("serve-"):
+            model_name = COMMAND[len("serve-"):]
+            hpo_config = load_hpo_config(model_name) if USE_HPO_CONFIG else None
+            tag_names = [f"PREDICTED_TAGS_{model_name.upper()}_{tag_postfix}" for tag_postfix in range(ENSEMBLE_SIZE)]
+            directories = train_ensemble(model_name, training, testing, validation, tag_names, fingerprint,
+                                         hpo_config, True)
+            with metrics.span("load_models"):
+                models = [load_model(directory, training) for directory in directories]
+            with metrics.span("db.get_parents"):
+                parents = session.execute_read(get_parents_query)
+            # only used by the worker thread of the service, which scores reports created after the snapshot
+            neighbour_session = driver.session()
+
+            def neighbour_reports(report_ids):
+                return neighbour_session.execute_read(get_neighbour_reports, report_ids)
+
+            with metrics.span("serve.warmup"):
+                scorer = TagScorer(models, snapshot["entity_ids"], parents, relation_id(snapshot, 'tag'),
+                                   neighbour_reports)
+            try:
+                serve(scorer)
+            finally:
+                neighbour_session.close()
+
+        metrics.report()
@@ -0,0 +1,148 @@
+"""
+Instrumentation of the pipeline stages: timed spans, counters and gauges, reported at the end of a run and exported
+as a JSON line or a Prometheus text file, and an optional cProfile of hot loops.
+
+METRICS_FILE: file the metrics of a run are exported to, in the Prometheus text format if it ends with .prom (for
+the textfile collector of the node exporter) and as a JSON line appended to it otherwise (unset: no export)
+PROFILE_DIR: directory the cProfile stats of the profiled loops are written to (unset: no profiling), the loops run
+in named functions, so they are also easy to find with a sampling profiler like py-spy
+METRICS_SERVICE: service label of the metrics (unset: the directory of the service)
+"""
+import cProfile
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+METRICS_FILE = os.getenv("METRICS_FILE") or None
+PROFILE_DIR = os.getenv("PROFILE_DIR") or None
+SERVICE = os.getenv("METRICS_SERVICE") or os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+_gauges = {}
+
+
+def observe(name, seconds):
+    """
+    Adds a measured duration of seconds to the span name.
+    """
+    with _lock:
+        span_stats = _spans.setdefault(name, [0, 0.0, 0.0])
+        span_stats[0] += 1
+        span_stats[1] += seconds
+        span_stats[2] = max(span_stats[2], seconds)
+
+
+@contextmanager
+def span(name):
+    """
+    Measures the wall time of the block as the span name, spans of the same name are aggregated. Yields a timer
+    whose seconds are set when the block is left.
+    """
+    timer = SimpleNamespace(seconds=0.0)
+    start = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        timer.seconds = time.perf_counter() - start
+        observe(name, timer.seconds)
+
+
+def count(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+
+def throughput(name, items, seconds):
+    """
+    Sets the gauge name_per_second to the rate of items processed in seconds.
+    """
+    if seconds > 0:
+        gauge(f"{name}_per_second", items / seconds)
+
+
+@contextmanager
+def profiled(name):
+    """
+    Profiles the block with cProfile if PROFILE_DIR is set and writes the stats to PROFILE_DIR/name.prof.
+    """
+    if PROFILE_DIR is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f"{name}.prof"))
+
+
+def snapshot():
+    """
+    Returns the current spans (count, total and max seconds), counters and gauges.
+    """
+    with _lock:
+        return dict(service=SERVICE, timestamp=time.time(),
+                    spans={name: dict(count=c, seconds=total, max_seconds=longest)
+                           for name, (c, total, longest) in _spans.items()},
+                    counters=dict(_counters), gauges=dict(_gauges))
+
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def prometheus_text(metrics):
+    lines = ["# TYPE waste_span_seconds_total counter", "# TYPE waste_span_count_total counter"]
+    for name, stats in metrics["spans"].items():
+        labels = f'{{service="{metrics["service"]}",span="{name}"}}'
+        lines.append(f"waste_span_seconds_total{labels} {stats['seconds']}")
+        lines.append(f"waste_span_count_total{labels} {stats['count']}")
+    for name, value in metrics["counters"].items():
+        lines.append(f"# TYPE waste_{_metric_name(name)}_total counter")
+        lines.append(f'waste_{_metric_name(name)}_total{{service="{metrics["service"]}"}} {value}')
+    for name, value in metrics["gauges"].items():
+        lines.append(f"# TYPE waste_{_metric_name(name)} gauge")
+        lines.append(f'waste_{_metric_name(name)}{{service="{metrics["service"]}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def export(path=METRICS_FILE):
+    """
+    Exports the current metrics to path, see METRICS_FILE.
+    """
+    if path is None:
+        return
+    metrics = snapshot()
+    if path.endswith(".prom"):
+        # the textfile collector must never read a partially written file
+        with open(path + ".tmp", "w") as f:
+            f.write(prometheus_text(metrics))
+        os.replace(path + ".tmp", path)
+    else:
+        with open(path, "a") as f:
+            f.write(json.dumps(metrics) + "\n")
+
+
+def report():
+    """
+    Prints the spans by total time, the counters and gauges and exports them.
+    """
+    metrics = snapshot()
+    for name, stats in sorted(metrics["spans"].items(), key=lambda item: -item[1]["seconds"]):
+        print(f"{name}: {stats['seconds']:.2f}s in {stats['count']} calls (max {stats['max_seconds']:.2f}s)")
+    for name, value in {**metrics["counters"], **metrics["gauges"]}.items():
+        print(f"{name}: {value}")
+    export()
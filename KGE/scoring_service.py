@@ -0,0 +1,270 @@
+"""
+Warm scoring service: keeps the trained models, the entity ids of their triple snapshot and the representations of
+all TrashTypes in memory and answers tag predictions of single reports over HTTP, so reports can be tagged as they
+arrive instead of by the next predict-* run. Started by the serve-* commands of main.py.
+
+POST /score {"reports": [<graph id>, ...], "k": 3}
+-> {"predictions": {"<graph id>": [{"trashtype": <graph id>, "score": ..., "variance": ...}, ...]},
+    "inductive": [...], "unknown": [...]}
+GET /health
+
+Concurrent requests are collected into micro-batches and scored in one forward pass. The embeddings are
+transductive: reports created after the snapshot of the models have no embedding, they are scored by the mean scores
+of their neighbour reports (of the same pickup) that are part of the snapshot and listed as inductive. Reports
+without such neighbours are returned as unknown until the models are retrained.
+"""
+import json
+import queue
+import threading
+from concurrent.futures import Future, TimeoutError as ResultTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from pykeen.models import ERModel
+
+import metrics
+
+SERVE_HOST = "0.0.0.0"
+SERVE_PORT = 8080
+# a micro-batch is scored as soon as it holds MAX_BATCH_REPORTS reports or its first request waited BATCH_WAIT_SECONDS
+MAX_BATCH_REPORTS = 4096
+BATCH_WAIT_SECONDS = 0.005
+DEFAULT_TOP_K = 3
+MAX_REQUEST_BYTES = 1024 ** 2
+# a request waiting longer for its micro-batch is answered with 503, e.g. if the worker thread died
+REQUEST_TIMEOUT_SECONDS = 30
+# pending connections queued by the listening socket
+REQUEST_QUEUE_SIZE = 128
+
+
+def _unsqueeze(representation, dim):
+    # relations of models like PairRE are represented by several tensors
+    if isinstance(representation, (tuple, list)):
+        return type(representation)(x.unsqueeze(dim) for x in representation)
+    return representation.unsqueeze(dim)
+
+
+class TagScorer:
+    """
+    Scores reports against all TrashTypes with an ensemble of models. For ERModels (TransE, PairRE, TuckER, ...) the
+    tail representations of the TrashTypes are computed once and only the head and relation representations are
+    looked up per batch, other models are scored by predict_t. neighbour_reports maps a list of report graph ids to
+    a dict from report graph id to the graph ids of its neighbour reports, it is only called for reports that are not
+    part of the snapshot.
+    """
+
+    def __init__(self, models, entity_ids, parents, relation_id, neighbour_reports=None, device=None):
+        self.models = models
+        self.neighbour_reports = neighbour_reports
+        self.entity_ids = np.asarray(entity_ids)
+        self.parents = np.asarray(parents)
+        self.relation_id = relation_id
+        self.device = device or models[0].device
+        target_ids = self.entity_ids_of(self.parents)
+        if (target_ids < 0).any():
+            raise ValueError("trash types are missing in the triple snapshot")
+        self.targets = torch.as_tensor(target_ids, dtype=torch.long, device=self.device)
+        self.tails = []
+        with torch.inference_mode():
+            for model in models:
+                model.eval()
+                if isinstance(model, ERModel):
+                    _, _, t = model._get_representations(h=None, r=None, t=self.targets, mode=None)
+                    self.tails.append(_unsqueeze(t, 0))
+                else:
+                    self.tails.append(None)
+
+    def entity_ids_of(self, graph_ids):
+        """
+        Maps graph ids to the entity ids of the models, ids that are not part of the snapshot are mapped to -1.
+        """
+        graph_ids = np.asarray(graph_ids, dtype=np.int64)
+        index = np.minimum(np.searchsorted(self.entity_ids, graph_ids), len(self.entity_ids) - 1)
+        return np.where(self.entity_ids[index] == graph_ids, index, -1)
+
+    def score(self, head_ids):
+        """
+        Returns the scores of all models, an array of shape (len(models), len(head_ids), len(parents)).
+        """
+        h = torch.as_tensor(np.asarray(head_ids), dtype=torch.long, device=self.device)
+        r = torch.full_like(h, self.relation_id)
+        scores = []
+        with torch.inference_mode():
+            for model, t in zip(self.models, self.tails):
+                if t is None:
+                    batch = model.predict_t(torch.stack([h, r], dim=1), tails=self.targets)
+                else:
+                    h_repr, r_repr, _ = model._get_representations(h=h, r=r, t=None, mode=None)
+                    batch = model.interaction(h=_unsqueeze(h_repr, 1), r=_unsqueeze(r_repr, 1), t=t)
+                scores.append(batch.float().cpu().numpy())
+        return np.stack(scores)
+
+    def top_tags(self, report_ids, k=DEFAULT_TOP_K):
+        """
+        Returns the k best TrashTypes of every report by the mean score over the models (with the variance over the
+        models), the reports scored by their neighbours and the reports that could not be scored.
+        """
+        report_ids = np.asarray(report_ids, dtype=np.int64)
+        head_ids = self.entity_ids_of(report_ids)
+        # the entity ids whose scores are averaged per report, a single one for reports of the snapshot
+        members = {int(report): [head] for report, head in zip(report_ids[head_ids >= 0], head_ids[head_ids >= 0])}
+        inductive = []
+        if self.neighbour_reports is not None and (head_ids < 0).any():
+            new_reports = list(dict.fromkeys(int(report) for report in report_ids[head_ids < 0]))
+            with metrics.span("serve.neighbour_reports"):
+                neighbours = self.neighbour_reports(new_reports)
+            for report in new_reports:
+                neighbour_ids = self.entity_ids_of(neighbours.get(report, []))
+                if (neighbour_ids >= 0).any():
+                    members[report] = neighbour_ids[neighbour_ids >= 0].tolist()
+                    inductive.append(report)
+        predictions = {}
+        if members:
+            reports = list(members)
+            counts = np.array([len(members[report]) for report in reports])
+            unique, inverse = np.unique(np.concatenate([members[report] for report in reports]), return_inverse=True)
+            scores = np.add.reduceat(self.score(unique)[:, inverse], np.cumsum(counts) - counts, axis=1)
+            scores /= counts[None, :, None]
+            mean, variance = scores.mean(axis=0), scores.var(axis=0)
+            best = np.argsort(-mean, axis=1, kind="stable")[:, :min(k, mean.shape[1])]
+            for row, (report, targets) in enumerate(zip(reports, best)):
+                predictions[str(report)] = [{'trashtype': int(self.parents[target]),
+                                             'score': float(mean[row, target]),
+                                             'variance': float(variance[row, target])}
+                                            for target in targets]
+        unknown = [int(report) for report in report_ids if int(report) not in members]
+        return predictions, inductive, unknown
+
+
+class MicroBatcher:
+    """
+    Collects the reports of concurrent requests and scores them in one pass in a single worker thread, which also
+    keeps the models from being used by several threads at once.
+    """
+
+    def __init__(self, scorer, max_reports=MAX_BATCH_REPORTS, wait_seconds=BATCH_WAIT_SECONDS):
+        self.scorer = scorer
+        self.max_reports = max_reports
+        self.wait_seconds = wait_seconds
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self.worker.start()
+
+    def submit(self, report_ids, k=DEFAULT_TOP_K):
+        """
+        Returns a future of the (predictions, inductive, unknown) of top_tags.
+        """
+        future = Future()
+        self.requests.put((list(report_ids), k, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        size = len(batch[0][0])
+        while size < self.max_reports:
+            try:
+                request = self.requests.get(timeout=self.wait_seconds)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            report_ids = [report for reports, _, _ in batch for report in reports]
+            k = max(request_k for _, request_k, _ in batch)
+            try:
+                with metrics.span("serve.batch"):
+                    predictions, inductive, unknown = self.scorer.top_tags(report_ids, k)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            metrics.count("serve.requests", len(batch))
+            metrics.count("serve.reports_scored", len(report_ids))
+            metrics.count("serve.reports_inductive", len(inductive))
+            metrics.gauge("serve.last_batch_reports", len(report_ids))
+            inductive, unknown = set(inductive), set(unknown)
+            for reports, request_k, future in batch:
+                future.set_result(({str(report): predictions[str(report)][:request_k]
+                                    for report in reports if str(report) in predictions},
+                                   [report for report in reports if report in inductive],
+                                   [report for report in reports if report in unknown]))
+
+
+def _handler(batcher):
+    class ScoringHandler(BaseHTTPRequestHandler):
+        def _send(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send(200, {'status': 'ok'})
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != "/score":
+                self._send(404, {'error': 'not found'})
+                return
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+            except ValueError:
+                length = -1
+            if length < 0:
+                self._send(400, {'error': 'invalid Content-Length'})
+                return
+            if length > MAX_REQUEST_BYTES:
+                self._send(413, {'error': 'request too large'})
+                return
+            try:
+                request = json.loads(self.rfile.read(length))
+                report_ids = [int(report) for report in request["reports"]]
+                k = int(request.get("k", DEFAULT_TOP_K))
+                if k < 1:
+                    raise ValueError("k must be positive")
+            except (ValueError, KeyError, TypeError) as e:
+                self._send(400, {'error': f"expected {{\"reports\": [<graph id>, ...], \"k\": <int>}}: {e}"})
+                return
+            try:
+                with metrics.span("serve.request"):
+                    predictions, inductive, unknown = batcher.submit(report_ids, k).result(REQUEST_TIMEOUT_SECONDS)
+            except ResultTimeout:
+                metrics.count("serve.requests_timed_out")
+                self._send(503, {'error': 'scoring timed out'})
+                return
+            except Exception as e:
+                self._send(500, {'error': str(e)})
+                return
+            self._send(200, {'predictions': predictions, 'inductive': inductive, 'unknown': unknown})
+
+        def log_message(self, format, *args):
+            pass
+
+    return ScoringHandler
+
+
+class ScoringServer(ThreadingHTTPServer):
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+
+def serve(scorer, host=SERVE_HOST, port=SERVE_PORT):
+    """
+    Answers scoring requests until interrupted.
+    """
+    server = ScoringServer((host, port), _handler(MicroBatcher(scorer)))
+    print(f"scoring service listening on {host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
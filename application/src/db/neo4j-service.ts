@@ -121,13 +121,15 @@ export async function createTag(layer: Layer, label: String, probability: number
         `MATCH (type:${layer}) WHERE type.label=$label 
         MATCH (report:${layer}) WHERE report.id=$reportId
         CREATE (report)-[r:tag]->(type)
-        SET r.probability=$probability`,
+        SET r.probability=$probability, report.pollution_dirty=true`,
         {id: id, label: label, probability: probability, reportId: reportId}
     )
 }
 
 /**
  * Creates a report node in the knowledge graph.
+ * Reports are flagged with pollution_dirty whenever they, their tags or their pickups change, the flag is cleared by
+ * refresh_pollution_aggregates of probabilistic-predictions.
  */
 export async function createReport(layer: Layer, statusId: String) {
     if (!writeSession) {
@@ -139,7 +141,7 @@ export async function createReport(layer: Layer, statusId: String) {
     await writeSession.run(
         `MATCH (status:${layer}) ` +
         `WHERE status.id=$statusId ` +
-        `CREATE (a:Report:${layer} {id: $id}) ` +
+        `CREATE (a:Report:${layer} {id: $id, pollution_dirty: true}) ` +
         `CREATE (a)-[r:status]->(status)`,
         {id: id, statusId: statusId}
     )
@@ -224,7 +226,10 @@ export async function addPreviousLayerReferenceToNode(upperLayer: Layer, lowerLa
     await writeSession.run(
         `MATCH (p:${upperLayer}), (p2:${lowerLayer})-[:location]->(l:Location:LAYER_1)
         WHERE p.id=$nodeId AND l.cluster_id=$cluster
-        CREATE (p)-[r:contains]->(p2)`,
+        CREATE (p)-[r:contains]->(p2)
+        WITH p2
+        MATCH (p2)-[:report]->(report:Report)
+        SET report.pollution_dirty=true`,
         {nodeId, cluster: clusterId}
     )
 }
@@ -415,6 +420,7 @@ export async function addReportToNode(layer: Layer, reportId: String, nodeId: St
         MATCH (report:${layer}) WHERE report.id=$reportId 
         MATCH (node:${layer}) WHERE node.id=$nodeId
         CREATE (node)-[r:report]->(report)
+        SET report.pollution_dirty=true
         `,
         {reportId: reportId, nodeId: nodeId, layer: layer}
     )
@@ -1,4 +1,13 @@
+import hashlib
+import json
 import os
+import resource
+import signal
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from multiprocessing import get_context
 
 import numpy as np
 import pyro
@@ -6,9 +15,15 @@ import pyro.distributions as dist
 import torch
 from dotenv import load_dotenv
 from neo4j import GraphDatabase
-from pyro.infer import NUTS, MCMC
+from pyro import poutine
+from pyro.infer import NUTS, MCMC, SVI, Predictive, Trace_ELBO, TraceEnum_ELBO, config_enumerate
+from pyro.infer.autoguide import AutoNormal
+from pyro.optim import Adam
 from scipy.stats import t, norm
 
+import metrics
+from synthetic import generate_pollution
+
 load_dotenv()
 
 USER = "neo4j"
@@ -20,11 +35,88 @@ AUTH = (USER, PASSWORD)
 # beta_max is the threshold for pollution level on pickup granularity, not to confuse with report granularity
 beta_max = 0.103
 
-def get_avg_pickup_event_pollution(tx):
+# months of the status timestamps the daily pollution is computed from
+POLLUTION_MONTHS = [1, 2, 3, 4]
+# only pickups whose daily pollution or model configuration changed since the last run are fitted and written, the
+# state is the pollution_fingerprint property of the pickup
+INCREMENTAL = False
+
+# number of posterior predictive samples drawn per posterior sample of the mixture model
+# (None: one per posterior sample)
+PREDICTIVE_SAMPLES = None
+
+# bayesian_prob is computed with the deterministic posterior of normal_model ("conjugate", see conjugate_normal_model),
+# with NUTS on normal_model ("nuts") or with both ("validate"), reporting how far NUTS and the deterministic posterior
+# disagree
+BAYESIAN_MODE = "conjugate"
+# number of pickups NUTS is run on in validate mode (None: all pickups)
+VALIDATION_PICKUPS = 20
+
+# priors of normal_model: mu ~ Normal(MU_PRIOR_MEAN, MU_PRIOR_STD), sigma ~ HalfCauchy(SIGMA_PRIOR_SCALE)
+MU_PRIOR_MEAN = 0.1
+MU_PRIOR_STD = 0.1
+SIGMA_PRIOR_SCALE = 0.2
+# the conjugate mode integrates log sigma over a fine grid around the sample standard deviation (in units of the
+# posterior standard deviation of log sigma) combined with a coarse grid over the range of the prior, for
+# CONJUGATE_CHUNK_SIZE pickups at a time
+SIGMA_GRID = np.linspace(-8, 8, 401)
+SIGMA_RANGE = np.geomspace(1e-4, 10 * SIGMA_PRIOR_SCALE, 201)
+CONJUGATE_CHUNK_SIZE = 256
+
+MCMC_SAMPLES = 500
+MCMC_WARMUP_STEPS = 100
+
+# posteriors of all pickups are inferred in a single batched model with "svi" (None: one MCMC per pickup), with
+# PARTIAL_POOLING the per-pickup means and standard deviations of the normal model are pooled toward the global mu_hat
+# and sigma_hat. "nuts" runs one chain over the joint posterior of all pickups (7 parameters per pickup for the
+# mixture), which gets slower with every pickup and is slower than one MCMC per pickup already for a few pickups, it
+# is only meant for checking the SVI posteriors on small data
+BATCHED_INFERENCE = None
+PARTIAL_POOLING = True
+SVI_STEPS = 3000
+SVI_LEARNING_RATE = 0.01
+
+# the per-pickup mixture model is fitted with NUTS ("nuts", enumerating the component of every observation), with NUTS
+# on the model with the components marginalized out ("nuts_marginalized") or with SVI and enumerated components ("svi")
+MIXTURE_INFERENCE = "nuts"
+MIXTURE_SVI_STEPS = 1000
+MIXTURE_SITES = ["weights", "mu1", "mu2", "mu3", "sigma1", "sigma2", "sigma3"]
+
+# per-pickup fits run in a pool of PICKUP_WORKERS spawned processes (1: in this process) with PICKUP_THREADS torch
+# threads each, a fit taking longer than PICKUP_TIMEOUT seconds falls back to the uninformed prior (None: no timeout)
+PICKUP_WORKERS = 1
+PICKUP_THREADS = 1
+PICKUP_TIMEOUT = 600
+# the random seed of a pickup fit is derived from SEED and the pickup id
+SEED = 0
+
+# number of pickups whose properties are written per transaction
+WRITE_CHUNK_SIZE = 1000
+
+# the daily pollution is read from the KG ("neo4j"), from SNAPSHOT_FILE written by the snapshot command ("file") or
+# generated for SYNTHETIC_PICKUPS pickups ("synthetic"), predict and snapshot always read from the KG
+DATA_SOURCE = "neo4j"
+SNAPSHOT_FILE = "pollution_snapshot.npz"
+SYNTHETIC_PICKUPS = 1000
+SYNTHETIC_DAYS = 120
+BENCHMARK_FILE = "benchmark.jsonl"
+
+# the daily pollution is read from the materialized PollutionDay nodes of the pickups, which are refreshed for the
+# days of the reports flagged by the writers (new, tagged or moved reports) and of deleted reports before (False:
+# aggregated from the reports on every run)
+AGGREGATED_POLLUTION = True
+
+# besides the probabilities at beta_max, the CDF of every model is evaluated at CDF_THRESHOLDS from the same fit and
+# stored as the <property>_cdf lists of P(pollution <= threshold) (the grid as cdf_thresholds), probabilities at other
+# thresholds are interpolated with interpolate_cdf instead of refitting
+CDF_THRESHOLDS = [round(0.005 * i, 3) for i in range(41)]
+
+
+def get_avg_pickup_event_pollution(tx, months=POLLUTION_MONTHS):
     return tx.run(
         f"""
       match (p2:PickUp:LAYER_2)-[:contains]-(p1:PickUp:LAYER_1)-[:report]->(r:Report)-[:status]->(s:Status)
-      where s.timestamp.month in [1,2,3,4]
+      where s.timestamp.month in $months
       call {{
         with r
         match (r)-[i:tag]->(t:TrashType)
@@ -33,28 +125,228 @@ def get_avg_pickup_event_pollution(tx):
       }}
       with left(toString(s.timestamp), 10) as date, p2, reportScore
       return p2.id, date, avg(reportScore) as avgtc
-    """).data()
+    """, {'months': months}).data()
+
+
+def get_changed_reports(tx, months=POLLUTION_MONTHS, rebuild=False):
+    """
+    Returns the ids of the reports flagged with pollution_dirty by the writers of reports, tags and pickups (see
+    application/src/db/neo4j-service.ts), with rebuild additionally all reports of the months.
+    """
+    if rebuild:
+        result = tx.run("""
+          match (r:Report)-[:status]->(s:Status)
+          where s.timestamp.month in $months or r.pollution_dirty = true
+          return id(r) as id
+        """, {'months': months})
+    else:
+        result = tx.run("""
+          match (r:Report)
+          where r.pollution_dirty = true
+          return id(r) as id
+        """)
+    return [record["id"] for record in result]
+
+
+def store_report_scores(tx, report_ids, months=POLLUTION_MONTHS):
+    """
+    Materializes the pollution score of the reports (as in get_avg_pickup_event_pollution) and clears their
+    pollution_dirty flag, returns the pickup days the reports belonged to (by the PollutionDay nodes computed from
+    them) and belong to now (only days of the months).
+    """
+    previous = tx.run("""
+      unwind $ids as report_id
+      match (p2:PickUp:LAYER_2)-[:pollution_day]->(d:PollutionDay)-[:pollution_report]->(r:Report)
+      where id(r) = report_id
+      return distinct p2.id as pickup, d.date as date
+    """, {'ids': report_ids}).data()
+    current = tx.run("""
+      unwind $ids as report_id
+      match (r:Report)
+      where id(r) = report_id
+      call {
+        with r
+        match (r)-[i:tag]->(t:TrashType)
+        with t, max(i.probability) as maxProb
+        return sum(maxProb*t.severity) as reportScore
+      }
+      set r.pollution_score = reportScore
+      remove r.pollution_dirty
+      with r
+      match (p2:PickUp:LAYER_2)-[:contains]-(p1:PickUp:LAYER_1)-[:report]->(r)-[:status]->(s:Status)
+      where s.timestamp.month in $months
+      return distinct p2.id as pickup, left(toString(s.timestamp), 10) as date
+    """, {'ids': report_ids, 'months': months}).data()
+    return previous + current
+
+
+def get_shrunk_days(tx, months=POLLUTION_MONTHS):
+    """
+    Returns the pickup days of the months that lost reports since their PollutionDay node was computed, e.g. by
+    deleted reports, PollutionDay nodes are linked to their reports by pollution_report edges.
+    """
+    return tx.run("""
+      match (p2:PickUp:LAYER_2)-[:pollution_day]->(d:PollutionDay)
+      where d.month in $months
+      optional match (d)-[e:pollution_report]->(:Report)
+      with p2, d, count(e) as reports
+      where reports <> d.reports
+      return p2.id as pickup, d.date as date
+    """, {'months': months}).data()
+
+
+def remove_orphaned_pollution_days(tx):
+    # PollutionDay nodes of deleted pickups, e.g. after LAYER_2 was rebuilt
+    return tx.run("""
+      match (d:PollutionDay)
+      where not (d)<-[:pollution_day]-(:PickUp:LAYER_2)
+      detach delete d
+      return count(d) as removed
+    """).single()["removed"]
+
+
+def store_pollution_days(tx, days):
+    """
+    Recomputes the PollutionDay nodes of the given pickup days from the materialized report scores and links them to
+    their reports, days without reports are removed.
+    """
+    tx.run("""
+      unwind $days as day
+      match (p2:PickUp:LAYER_2 {id: day.pickup})-[:pollution_day]->(d:PollutionDay {date: day.date})
+      detach delete d
+    """, {'days': days})
+    tx.run("""
+      unwind $days as day
+      match (p2:PickUp:LAYER_2 {id: day.pickup})-[:contains]-(p1:PickUp:LAYER_1)-[:report]->(r:Report)
+      match (r)-[:status]->(s:Status)
+      where left(toString(s.timestamp), 10) = day.date
+      with p2, day, avg(r.pollution_score) as avgtc, collect(r) as reports
+      create (p2)-[:pollution_day]->(d:PollutionDay {
+        date: day.date, month: toInteger(substring(day.date, 5, 2)), avgtc: avgtc, reports: size(reports)
+      })
+      foreach (r in reports | create (d)-[:pollution_report]->(r))
+    """, {'days': days})
+
+
+def remove_pollution_aggregates(tx):
+    tx.run("""
+      match (d:PollutionDay)
+      detach delete d
+    """)
+    tx.run("""
+      match (r:Report)
+      remove r.pollution_score, r.pollution_tags, r.pollution_probability
+    """)
+
+
+def refresh_pollution_aggregates(session, rebuild=False, months=POLLUTION_MONTHS, chunk_size=WRITE_CHUNK_SIZE):
+    """
+    Materializes the pollution score of the reports flagged with pollution_dirty and recomputes the PollutionDay
+    nodes (of the months) of the pickup days they belonged to and belong to now, and of the days that lost reports,
+    chunk_size reports or days are written per transaction. With rebuild, all aggregates are removed and computed from
+    scratch, which is needed once for graphs written before the writers flagged their reports.
+    """
+    if rebuild:
+        with metrics.span("db.remove_pollution_aggregates"):
+            session.execute_write(remove_pollution_aggregates)
+    with metrics.span("db.remove_orphaned_pollution_days"):
+        orphaned = session.execute_write(remove_orphaned_pollution_days)
+    with metrics.span("db.get_changed_reports"):
+        report_ids = session.execute_read(get_changed_reports, months, rebuild)
+    days = set()
+    for start in range(0, len(report_ids), chunk_size):
+        with metrics.span("db.store_report_scores"):
+            rows = session.execute_write(store_report_scores, report_ids[start:start + chunk_size], months)
+        days.update((row["pickup"], row["date"]) for row in rows)
+    with metrics.span("db.get_shrunk_days"):
+        shrunk_days = {(row["pickup"], row["date"]) for row in session.execute_read(get_shrunk_days, months)}
+    days = [{"pickup": pickup, "date": date} for pickup, date in sorted(days | shrunk_days)]
+    for start in range(0, len(days), chunk_size):
+        with metrics.span("db.store_pollution_days"):
+            session.execute_write(store_pollution_days, days[start:start + chunk_size])
+    metrics.count("reports_scored", len(report_ids))
+    metrics.count("pollution_days_refreshed", len(days))
+    print(f"scored {len(report_ids)} new or changed reports, refreshed {len(days)} pickup days "
+          f"({len(shrunk_days)} with deleted reports), removed {orphaned} days of deleted pickups")
+
+
+def create_report_index(driver, session):
+    """
+    Creates the index on Report.pollution_dirty get_changed_reports looks the flagged reports up by, if it does not
+    exist yet, in the syntax of the database the driver is connected to.
+    """
+    if "memgraph" in driver.get_server_info().agent.lower():
+        session.run("CREATE INDEX ON :Report(pollution_dirty)").consume()
+    else:
+        session.run("CREATE INDEX report_pollution_dirty IF NOT EXISTS FOR (r:Report) ON (r.pollution_dirty)").consume()
+
+
+def get_pollution_days(tx, months=POLLUTION_MONTHS):
+    return tx.run("""
+      match (p2:PickUp:LAYER_2)-[:pollution_day]->(d:PollutionDay)
+      where d.month in $months
+      return p2.id, d.date as date, d.avgtc as avgtc
+    """, {'months': months}).data()
 
 
 def get_pickups(tx):
     return tx.run(f"""
     match (p2:PickUp:LAYER_2)
-    return p2.id
+    return p2.id, p2.pollution_fingerprint
     """).data()
 
 
-def write_property_to_pickup(tx, pickup_id, property_name, value):
-    tx.run(f"""
-        MATCH (n:PickUp:LAYER_2)
-        WHERE n.id = $pickup_id
-        SET n.{property_name} = $value
-        """, {'pickup_id': pickup_id, 'value': value})
+def create_pickup_constraint(driver, session):
+    """
+    Creates the uniqueness constraint on PickUp.id the property writes look pickups up by, if it does not exist yet,
+    in the syntax of the database the driver is connected to.
+    """
+    # Memgraph identifies itself as "Neo4j/v5.x compatible graph database server - Memgraph"
+    if "memgraph" in driver.get_server_info().agent.lower():
+        # the constraint does not come with an index in Memgraph
+        session.run("CREATE CONSTRAINT ON (n:PickUp) ASSERT n.id IS UNIQUE").consume()
+        session.run("CREATE INDEX ON :PickUp(id)").consume()
+    else:
+        session.run("CREATE CONSTRAINT pickup_id IF NOT EXISTS FOR (n:PickUp) REQUIRE n.id IS UNIQUE").consume()
+
+
+def store_pickup_properties(tx, rows):
+    tx.run("""
+        UNWIND $rows as row
+        MATCH (n:PickUp:LAYER_2 {id: row.id})
+        SET n.t_prob = row.t_prob,
+            n.normal_prob = row.normal_prob,
+            n.bayesian_prob = row.bayesian_prob,
+            n.bayesian_prob_mixed = row.bayesian_prob_mixed,
+            n.t_prob_cdf = row.t_prob_cdf,
+            n.normal_prob_cdf = row.normal_prob_cdf,
+            n.bayesian_prob_cdf = row.bayesian_prob_cdf,
+            n.bayesian_prob_mixed_cdf = row.bayesian_prob_mixed_cdf,
+            n.cdf_thresholds = $thresholds,
+            n.pollution_fingerprint = row.pollution_fingerprint
+        """, {'rows': rows, 'thresholds': CDF_THRESHOLDS})
+
+
+def write_pickup_properties(session, results, chunk_size=WRITE_CHUNK_SIZE):
+    """
+    Writes the properties of the pickups, results maps a pickup id to a dict from property name to value (a missing
+    pollution_fingerprint removes it), chunk_size pickups are written per transaction.
+    """
+    rows = [dict(properties, id=pickup_id) for pickup_id, properties in results.items()]
+    with metrics.span("write_pickup_properties") as timer:
+        for start in range(0, len(rows), chunk_size):
+            with metrics.span("db.store_pickup_properties"):
+                session.execute_write(store_pickup_properties, rows[start:start + chunk_size])
+    metrics.count("pickups_written", len(rows))
+    metrics.throughput("pickups_written", len(rows), timer.seconds)
+    print(f"stored the properties of {len(rows)} pickups")
 
 
 def normal_model(data):
     # Hyperparameters for the pollution level
-    mu = pyro.sample("mu", dist.Normal(0.1, 0.1))  # Prior for the initial pollution level
-    sigma = pyro.sample("sigma", dist.HalfCauchy(0.2))  # Standard deviation for noise in daily pollution change
+    mu = pyro.sample("mu", dist.Normal(MU_PRIOR_MEAN, MU_PRIOR_STD))  # Prior for the initial pollution level
+    # Standard deviation for noise in daily pollution change
+    sigma = pyro.sample("sigma", dist.HalfCauchy(SIGMA_PRIOR_SCALE))
 
     with pyro.plate("data", len(data)):
         pyro.sample("obs", dist.Normal(mu, sigma), obs=data)
@@ -90,6 +382,134 @@ def tri_normal_model(data):
         pyro.sample("obs", dist.Normal(mu, sigma), obs=data)
 
 
+def batched_normal_model(data, mask, mu_hat=None, sigma_hat=None):
+    """
+    normal_model of all pickups at once, data holds the observations of a pickup per row padded to the same length,
+    mask marks the actual observations. If mu_hat and sigma_hat are given the pickups are partially pooled toward them.
+    """
+    if mu_hat is not None:
+        tau = pyro.sample("tau", dist.HalfCauchy(sigma_hat))  # Spread of the pollution level across pickups
+    with pyro.plate("pickups", data.shape[0], dim=-2):
+        if mu_hat is None:
+            mu = pyro.sample("mu", dist.Normal(MU_PRIOR_MEAN, MU_PRIOR_STD))
+            sigma = pyro.sample("sigma", dist.HalfCauchy(SIGMA_PRIOR_SCALE))
+        else:
+            mu = pyro.sample("mu", dist.Normal(mu_hat, tau))
+            sigma = pyro.sample("sigma", dist.HalfCauchy(sigma_hat))
+
+        with pyro.plate("data", data.shape[1], dim=-1), poutine.mask(mask=mask):
+            pyro.sample("obs", dist.Normal(mu, sigma), obs=data)
+
+
+def batched_tri_normal_model(data, mask):
+    """
+    tri_normal_model of all pickups at once (see batched_normal_model), with the component indices marginalized out.
+    """
+    with pyro.plate("pickups", data.shape[0], dim=-2):
+        weights = pyro.sample("weights", dist.Dirichlet(torch.tensor([0.1, 0.5, 0.4])))
+
+        mu1 = pyro.sample("mu1", dist.Normal(0.0, 0.01))
+        mu2 = pyro.sample("mu2", dist.Normal(0.095, 0.01))
+        mu3 = pyro.sample("mu3", dist.Normal(0.08, 0.02))
+
+        sigma1 = pyro.sample("sigma1", dist.HalfCauchy(0.005))
+        sigma2 = pyro.sample("sigma2", dist.HalfCauchy(0.01))
+        sigma3 = pyro.sample("sigma3", dist.HalfCauchy(0.03))
+
+        mixture = dist.MixtureSameFamily(dist.Categorical(weights),
+                                         dist.Normal(torch.stack([mu1, mu2, mu3], dim=-1),
+                                                     torch.stack([sigma1, sigma2, sigma3], dim=-1)))
+        with pyro.plate("data", data.shape[1], dim=-1), poutine.mask(mask=mask):
+            pyro.sample("obs", mixture, obs=data)
+
+
+def pad_series(series):
+    """
+    Returns the per-pickup observations as a zero padded tensor with one row per pickup and the mask of observations.
+    """
+    length = max(len(values) for values in series)
+    data = torch.zeros(len(series), length)
+    mask = torch.zeros(len(series), length, dtype=torch.bool)
+    for i, values in enumerate(series):
+        data[i, :len(values)] = torch.tensor(values)
+        mask[i, :len(values)] = True
+    return data, mask
+
+
+def fit_batched(model, series, sites, method="svi", **kwargs):
+    """
+    Fits a batched model to the observations of all pickups with SVI (or NUTS, see BATCHED_INFERENCE) and returns the
+    posterior samples of every pickup in the format of mcmc.get_samples() of the per-pickup model.
+    """
+    data, mask = pad_series(series)
+    if method == "nuts":
+        mcmc = MCMC(NUTS(model), num_samples=MCMC_SAMPLES, warmup_steps=MCMC_WARMUP_STEPS)
+        mcmc.run(data, mask, **kwargs)
+        samples = mcmc.get_samples()
+    elif method == "svi":
+        pyro.clear_param_store()
+        guide = AutoNormal(model)
+        svi = SVI(model, guide, Adam({"lr": SVI_LEARNING_RATE}), Trace_ELBO())
+        for step in range(SVI_STEPS):
+            loss = svi.step(data, mask, **kwargs)
+            if step % 500 == 0:
+                print(f"SVI step {step}/{SVI_STEPS} loss {loss:.1f}")
+        samples = Predictive(model, guide=guide, num_samples=MCMC_SAMPLES, return_sites=sites)(data, mask, **kwargs)
+    else:
+        raise ValueError(f"unknown inference method {method}")
+    return [{site: samples[site][:, i].reshape(len(samples[site]), -1).squeeze(-1) for site in sites}
+            for i in range(len(series))]
+
+
+def fit_mixture(pickup_pollution, method=MIXTURE_INFERENCE, progress_bar=True):
+    """
+    Fits tri_normal_model to the observations of a pickup and returns the posterior samples in the format of
+    mcmc.get_samples().
+    """
+    data = torch.tensor(pickup_pollution, dtype=torch.float32)
+    if method == "nuts":
+        nuts_kernel = NUTS(tri_normal_model)
+        mcmc = MCMC(nuts_kernel, num_samples=MCMC_SAMPLES, warmup_steps=MCMC_WARMUP_STEPS,
+                    disable_progbar=not progress_bar)
+        mcmc.run(data)
+        # print(mcmc.summary())
+        return mcmc.get_samples()
+    if method == "nuts_marginalized":
+        return fit_batched(batched_tri_normal_model, [pickup_pollution], MIXTURE_SITES, "nuts")[0]
+    if method == "svi":
+        pyro.clear_param_store()
+        model = config_enumerate(tri_normal_model, "parallel")
+        guide = AutoNormal(poutine.block(model, hide=["component"]))
+        svi = SVI(model, guide, Adam({"lr": SVI_LEARNING_RATE}), TraceEnum_ELBO(max_plate_nesting=1))
+        for _ in range(MIXTURE_SVI_STEPS):
+            svi.step(data)
+        samples = Predictive(guide, num_samples=MCMC_SAMPLES)(data)
+        return {site: samples[site] for site in MIXTURE_SITES}
+    raise ValueError(f"unknown inference method {method}")
+
+
+def empirical_cdf(samples, thresholds=CDF_THRESHOLDS):
+    """
+    Returns the fraction of the samples <= each of the thresholds.
+    """
+    samples = torch.sort(samples.reshape(-1)).values
+    positions = torch.searchsorted(samples, torch.tensor(thresholds, dtype=samples.dtype), right=True)
+    return (positions / len(samples)).tolist()
+
+
+def interpolate_cdf(cdfs, threshold, thresholds=CDF_THRESHOLDS):
+    """
+    Returns P(pollution <= threshold) of stored <property>_cdf lists (one list or an array of one list per pickup),
+    linearly interpolated between the thresholds of the grid and clamped to its ends. bayesian_prob_mixed is the
+    probability of exceeding beta_max, i.e. 1 - interpolate_cdf(bayesian_prob_mixed_cdf, beta_max).
+    """
+    cdfs = np.asarray(cdfs, dtype=float)
+    thresholds = np.asarray(thresholds, dtype=float)
+    position = np.clip(np.searchsorted(thresholds, threshold, side="right") - 1, 0, len(thresholds) - 2)
+    weight = np.clip((threshold - thresholds[position]) / (thresholds[position + 1] - thresholds[position]), 0, 1)
+    return cdfs[..., position] * (1 - weight) + cdfs[..., position + 1] * weight
+
+
 def predictive_model(posterior_samples, threshold):
     mu_samples = posterior_samples["mu"]
     sigma_samples = posterior_samples["sigma"]
@@ -101,135 +521,465 @@ def predictive_model(posterior_samples, threshold):
 
     # Compute the probability of exceeding the threshold
     prob_exceed = (samples <= threshold).float().mean().item()
-    return prob_exceed, sum(mu_samples) / len(samples), sum(sigma_samples) / len(samples)
+    return (prob_exceed, sum(mu_samples) / len(samples), sum(sigma_samples) / len(samples),
+            empirical_cdf(samples))
 
 
-def predictive_model_tri(posterior_samples, threshold):
+def predictive_model_tri(posterior_samples, threshold, num_samples=PREDICTIVE_SAMPLES):
     m_samples = posterior_samples["weights"]
-    mu1_samples = posterior_samples["mu1"]
-    mu2_samples = posterior_samples["mu2"]
-    mu3_samples = posterior_samples["mu3"]
-    sigma1_samples = posterior_samples["sigma1"]
-    sigma2_samples = posterior_samples["sigma2"]
-    sigma3_samples = posterior_samples["sigma3"]
+    mus = torch.stack([posterior_samples["mu1"], posterior_samples["mu2"], posterior_samples["mu3"]], dim=-1)
+    sigmas = torch.stack([posterior_samples["sigma1"], posterior_samples["sigma2"], posterior_samples["sigma3"]],
+                         dim=-1)
     n_samples = len(m_samples)
+    num_samples = num_samples or n_samples
     print(f"samples {n_samples}")
 
-    # Simulate new data points from the posterior predictive distribution
-    predictive_dist1 = dist.Normal(mu1_samples, sigma1_samples)
-    predictive_dist2 = dist.Normal(mu2_samples, sigma2_samples)
-    predictive_dist3 = dist.Normal(mu3_samples, sigma3_samples)
-    samples1 = predictive_dist1.sample(sample_shape=(n_samples,))
-    samples2 = predictive_dist2.sample(sample_shape=(n_samples,))
-    samples3 = predictive_dist3.sample(sample_shape=(n_samples,))
-    x = np.random.choice([0, 1, 2], (n_samples, n_samples),
-                         p=[np.mean(m_samples[:, 0].numpy()), np.mean(m_samples[:, 1].numpy()),
-                            1 - np.mean(m_samples[:, 0].numpy()) - np.mean(m_samples[:, 1].numpy())])
-    combined_samples = np.array([[samples1[i][j] if x[i][j] == 0 else samples2[i][j] if x[i][j] == 1 else samples3[i][j]
-                                  for j in range(n_samples)] for i in range(n_samples)]).flatten()
-
-    prob_exceed = torch.tensor(combined_samples > threshold).float().mean().item()
+    # Simulate new data points from the posterior predictive distribution: for every posterior sample, draw the
+    # component from its weights and the value from the normal distribution of that component
+    components = dist.Categorical(m_samples).sample(sample_shape=(num_samples,)).unsqueeze(-1)
+    mu = mus.expand(num_samples, -1, -1).gather(-1, components).squeeze(-1)
+    sigma = sigmas.expand(num_samples, -1, -1).gather(-1, components).squeeze(-1)
+    combined_samples = dist.Normal(mu, sigma).sample()
+
+    prob_exceed = (combined_samples > threshold).float().mean().item()
+    mu_means = mus.mean(dim=0)
+    sigma_means = sigmas.mean(dim=0)
     return (prob_exceed,
-            sum(mu1_samples) / n_samples,
-            sum(sigma1_samples) / n_samples,
-            sum(mu2_samples) / n_samples,
-            sum(sigma2_samples) / n_samples,
-            sum(mu3_samples) / n_samples,
-            sum(sigma3_samples) / n_samples,
-            np.mean(m_samples[:, 0].numpy()),
-            np.mean(m_samples[:, 1].numpy()))
+            mu_means[0],
+            sigma_means[0],
+            mu_means[1],
+            sigma_means[1],
+            mu_means[2],
+            sigma_means[2],
+            m_samples[:, 0].mean(),
+            m_samples[:, 1].mean(),
+            empirical_cdf(combined_samples))
+
+
+def conjugate_normal_model(counts, means, sse, threshold, chunk_size=CONJUGATE_CHUNK_SIZE):
+    """
+    Posterior of normal_model without sampling, vectorized over pickups given the number of observations, their mean
+    and their sum of squared deviations from the mean. Given sigma, the normal prior of mu is conjugate, so mu is
+    integrated out in closed form and sigma numerically over SIGMA_GRID. Returns the probability of the posterior
+    predictive to be <= threshold (as predictive_model, one column per threshold if threshold is an array) and the
+    posterior means of mu and sigma.
+    """
+    counts, means, sse = (np.asarray(x, dtype=float) for x in (counts, means, sse))
+    thresholds = np.atleast_1d(np.asarray(threshold, dtype=float))
+    prob = np.empty((len(counts), len(thresholds)))
+    mu_mean, sigma_mean = np.empty(len(counts)), np.empty(len(counts))
+    for start in range(0, len(counts), chunk_size):
+        n, mean, ss = (x[start:start + chunk_size, None] for x in (counts, means, sse))
+        # log sigma has a posterior standard deviation of about 1 / sqrt(2 (n - 1)), but a long tail toward the prior
+        # if the observations hardly vary
+        local = np.log(np.maximum(np.sqrt(ss / n), 1e-4)) + SIGMA_GRID / np.sqrt(2 * np.maximum(n - 1, 1))
+        log_sigma = np.sort(np.concatenate([local, np.broadcast_to(np.log(SIGMA_RANGE), (len(n), len(SIGMA_RANGE)))],
+                                           axis=1), axis=1)
+        sigma = np.exp(log_sigma)
+        # posterior density of log sigma: likelihood with mu integrated out, HalfCauchy prior and the jacobian
+        log_density = (-(n - 1) * log_sigma - ss / (2 * np.square(sigma))
+                       + norm.logpdf(mean, MU_PRIOR_MEAN, np.sqrt(MU_PRIOR_STD ** 2 + np.square(sigma) / n))
+                       - np.log1p(np.square(sigma / SIGMA_PRIOR_SCALE)) + log_sigma)
+        # midpoint rule on the uneven grid
+        weights = np.exp(log_density - log_density.max(axis=1, keepdims=True)) * np.gradient(log_sigma, axis=1)
+        weights /= weights.sum(axis=1, keepdims=True)
+        # normal posterior of mu given sigma and the normal posterior predictive given sigma
+        precision = 1 / MU_PRIOR_STD ** 2 + n / np.square(sigma)
+        mu = (MU_PRIOR_MEAN / MU_PRIOR_STD ** 2 + n * mean / np.square(sigma)) / precision
+        scale = np.sqrt(np.square(sigma) + 1 / precision)
+        cdf = norm.cdf((thresholds - mu[..., None]) / scale[..., None])
+        prob[start:start + chunk_size] = (weights[..., None] * cdf).sum(axis=1)
+        mu_mean[start:start + chunk_size] = (weights * mu).sum(axis=1)
+        sigma_mean[start:start + chunk_size] = (weights * sigma).sum(axis=1)
+    return prob if np.ndim(threshold) else prob[:, 0], mu_mean, sigma_mean
+
+
+def pollution_columns(avg_pollution_per_pickup_and_day):
+    """
+    Returns the pickup ids, dates and values of the rows of get_avg_pickup_event_pollution as arrays.
+    """
+    return (np.array([row['p2.id'] for row in avg_pollution_per_pickup_and_day]),
+            np.array([row['date'] for row in avg_pollution_per_pickup_and_day]),
+            np.array([row['avgtc'] for row in avg_pollution_per_pickup_and_day], dtype=float))
+
+
+def load_pollution(source=DATA_SOURCE, session=None):
+    """
+    Returns the daily pollution as (pickup ids, dates, values) arrays and a dict from the id of every LAYER_2 pickup
+    to its stored pollution_fingerprint, read from the KG, the snapshot file or generated.
+    """
+    if source == "neo4j":
+        if AGGREGATED_POLLUTION:
+            refresh_pollution_aggregates(session)
+            with metrics.span("db.get_pollution_days"):
+                columns = pollution_columns(session.execute_read(get_pollution_days))
+        else:
+            with metrics.span("db.get_avg_pickup_event_pollution"):
+                columns = pollution_columns(session.execute_read(get_avg_pickup_event_pollution))
+        with metrics.span("db.get_pickups"):
+            pickups = {i['p2.id']: i['p2.pollution_fingerprint'] for i in session.execute_read(get_pickups)}
+    elif source == "file":
+        with np.load(SNAPSHOT_FILE) as snapshot:
+            columns = snapshot["ids"], snapshot["dates"], snapshot["values"]
+            pickups = dict.fromkeys(snapshot["pickup_ids"].tolist())
+    elif source == "synthetic":
+        *columns, pickup_ids = generate_pollution(SYNTHETIC_PICKUPS, SYNTHETIC_DAYS, SEED)
+        pickups = dict.fromkeys(pickup_ids.tolist())
+    else:
+        raise ValueError(f"unknown data source {source}")
+    metrics.count("pollution_rows_read", len(columns[2]))
+    print(f"loaded {len(columns[2])} daily pollution values of {len(pickups)} pickups from {source}")
+    return columns, pickups
+
+
+def save_pollution_snapshot(columns, pickups, path=SNAPSHOT_FILE):
+    ids, dates, values = columns
+    np.savez(path, ids=ids, dates=dates, values=values, pickup_ids=np.array(list(pickups)))
+    print(f"saved the daily pollution to {path}")
+
+
+def group_pollution(ids, dates, values):
+    """
+    Groups the daily pollution values by pickup, returns the sorted pickup ids, the values and dates sorted by pickup
+    and date and the offsets of the values of every pickup, the values of pickup_ids[i] are
+    values[offsets[i]:offsets[i + 1]].
+    """
+    order = np.lexsort((dates, ids))
+    pickup_ids, starts = np.unique(ids[order], return_index=True)
+    return pickup_ids, values[order], dates[order], np.append(starts, len(ids))
+
+
+def pollution_fingerprints(values, dates, offsets):
+    """
+    Returns the fingerprint of the daily pollution of every pickup: the number of days, the last date and a digest
+    of the values and of the configuration the models are fitted with.
+    """
+    config = json.dumps([POLLUTION_MONTHS, beta_max, BAYESIAN_MODE, MU_PRIOR_MEAN, MU_PRIOR_STD, SIGMA_PRIOR_SCALE,
+                         SIGMA_GRID.tolist(), SIGMA_RANGE.tolist(),
+                         MCMC_SAMPLES, MCMC_WARMUP_STEPS, BATCHED_INFERENCE, PARTIAL_POOLING, SVI_STEPS,
+                         SVI_LEARNING_RATE, MIXTURE_INFERENCE, MIXTURE_SVI_STEPS, PREDICTIVE_SAMPLES,
+                         SEED, CDF_THRESHOLDS]).encode()
+    fingerprints = []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        digest = hashlib.sha1(values[start:end].tobytes() + config).hexdigest()[:16]
+        fingerprints.append(f"{end - start}:{dates[end - 1]}:{digest}")
+    return fingerprints
+
+
+def pickup_statistics(values, offsets):
+    """
+    Returns the number of observations, their mean, their sum of squared deviations from the mean and their sample
+    standard deviation per pickup (nan for pickups with a single observation).
+    """
+    counts = np.diff(offsets)
+    means = np.add.reduceat(values, offsets[:-1]) / counts
+    sse = np.add.reduceat(np.square(values - np.repeat(means, counts)), offsets[:-1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sigmas = np.sqrt(sse / (counts - 1)) + 1e-6
+    return counts, means, sse, sigmas
+
+
+def t_probabilities(counts, means, sigmas, threshold):
+    """
+    Returns the probability of the t-test that the pollution level is <= threshold, vectorized over pickups.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return t.cdf((threshold - means) / (sigmas / np.sqrt(counts)), df=counts - 1)
+
+
+def normal_probabilities(means, sigmas, threshold):
+    """
+    Returns the probability of the fitted normal distribution to be <= threshold, vectorized over pickups.
+    """
+    return norm.cdf((threshold - means) / sigmas)
+
+
+def report_disagreement(differences):
+    """
+    Prints the mean and maximum absolute difference between NUTS and the conjugate normal model.
+    """
+    if not differences:
+        return
+    differences = np.abs(np.array(differences))
+    for name, column in zip(["prob", "mu", "sigma"], differences.T):
+        print(f"NUTS vs. conjugate {name}: mean abs diff {column.mean():.5f}, max abs diff {column.max():.5f}")
+
+
+def uninformed_properties(uninformed_probability, uninformed_cdf, mu_hat, sigma_hat):
+    """
+    Returns the pickup properties of a pickup without enough observations for a fit.
+    """
+    return {
+        "t_prob": {"prob": uninformed_probability, "dist": {"mu": mu_hat, "sigma": sigma_hat, "n": "1"}},
+        "normal_prob": {"prob": uninformed_probability, "dist": {"mu": mu_hat, "sigma": sigma_hat}},
+        "bayesian_prob": {"prob": uninformed_probability, "dist": {"mu": mu_hat, "sigma": sigma_hat}},
+        "bayesian_prob_mixed": uninformed_probability,
+        "t_prob_cdf": uninformed_cdf,
+        "normal_prob_cdf": uninformed_cdf,
+        "bayesian_prob_cdf": uninformed_cdf,
+        "bayesian_prob_mixed_cdf": uninformed_cdf
+    }
+
+
+def _raise_timeout(signum, frame):
+    raise TimeoutError("pickup fit timed out")
+
+
+def _init_pickup_worker(threads):
+    torch.set_num_threads(threads)
+
+
+def fit_pickup(selected, pickup_pollution, conjugate_fit, run_nuts, normal_posterior=None, mixture_posterior=None,
+               timeout=None, progress_bar=True):
+    """
+    Fits the Bayesian models of a single pickup and returns its bayesian_prob and bayesian_prob_mixed properties,
+    the difference between NUTS and the conjugate normal model (None if NUTS was not run) and the seconds spent per
+    model. normal_posterior and mixture_posterior are posterior samples of a batched fit, without them the
+    posteriors are sampled with NUTS.
+    """
+    seconds = {}
+    if timeout and hasattr(signal, "SIGALRM"):
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.alarm(timeout)
+    try:
+        pyro.set_rng_seed(zlib.crc32(f"{SEED}:{selected}".encode()))
+        bayesian_prob, bayesian_mu, bayesian_sigma, bayesian_cdf = conjugate_fit
+        difference = None
+        if run_nuts:
+            start = time.perf_counter()
+            posterior_samples = normal_posterior
+            if posterior_samples is None:
+                data = torch.tensor(pickup_pollution)
+                nuts_kernel = NUTS(normal_model)
+                mcmc = MCMC(nuts_kernel, num_samples=MCMC_SAMPLES, warmup_steps=MCMC_WARMUP_STEPS,
+                            disable_progbar=not progress_bar)
+                mcmc.run(data)
+
+                # Extract posterior samples
+                posterior_samples = mcmc.get_samples()
+            nuts_prob, nuts_mu, nuts_sigma, nuts_cdf = predictive_model(posterior_samples, beta_max)
+            difference = [nuts_prob - bayesian_prob, nuts_mu.item() - bayesian_mu, nuts_sigma.item() - bayesian_sigma]
+            if BAYESIAN_MODE == "nuts":
+                bayesian_prob, bayesian_mu, bayesian_sigma, bayesian_cdf = nuts_prob, nuts_mu, nuts_sigma, nuts_cdf
+            seconds["bayesian"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        posterior_samples = mixture_posterior
+        if posterior_samples is None:
+            posterior_samples = fit_mixture(pickup_pollution, progress_bar=progress_bar)
+        bayesian_prob_mixed, b_mu1, b_s1, b_mu2, b_s2, b_mu3, b_s3, b_w1, b_w2, mixed_cdf = predictive_model_tri(
+            posterior_samples, beta_max)
+        seconds["mixture"] = time.perf_counter() - start
+    finally:
+        if timeout and hasattr(signal, "SIGALRM"):
+            signal.alarm(0)
+
+    return {
+        "bayesian_prob": {
+            "prob": float(bayesian_prob),
+            "dist": {
+                "mu": bayesian_mu.item(),
+                "sigma": bayesian_sigma.item()
+            }
+        },
+        "bayesian_prob_mixed": {
+            "prob": bayesian_prob_mixed,
+            "dist": {
+                "mu1": b_mu1.item(),
+                "sigma1": b_s1.item(),
+                "mu2": b_mu2.item(),
+                "sigma2": b_s2.item(),
+                "mu3": b_mu3.item(),
+                "sigma3": b_s3.item(),
+                "weights": [b_w1.item(), b_w2.item()]
+            }
+        },
+        "bayesian_prob_cdf": [float(p) for p in bayesian_cdf],
+        "bayesian_prob_mixed_cdf": mixed_cdf
+    }, difference, seconds
+
+
+def fit_pickups(tasks, fallback, workers=PICKUP_WORKERS, threads_per_worker=PICKUP_THREADS, timeout=PICKUP_TIMEOUT):
+    """
+    Runs fit_pickup for every task (a tuple of its positional arguments) in this process or in a pool of spawned
+    worker processes and yields (pickup id, properties, difference, seconds) in the order the fits complete. A failing
+    or timed out fit is reported and yields the fallback properties.
+    """
+    executor = None
+    if workers > 1 and len(tasks) > 1:
+        executor = ProcessPoolExecutor(workers, mp_context=get_context("spawn"), initializer=_init_pickup_worker,
+                                       initargs=(threads_per_worker,))
+        futures = {executor.submit(fit_pickup, *task, timeout=timeout, progress_bar=False): task[0] for task in tasks}
+        completed = ((futures[future], future.result) for future in as_completed(futures))
+    else:
+        completed = ((task[0], partial(fit_pickup, *task, timeout=timeout)) for task in tasks)
+    start = time.time()
+    try:
+        for done, (selected, result) in enumerate(completed, start=1):
+            try:
+                properties, difference, seconds = result()
+                metrics.count("pickups_fitted")
+                print(f"Progress {done}/{len(tasks)}: pickup {selected} ({time.time() - start:.0f}s)")
+            except Exception as e:
+                metrics.count("pickup_fit_failures")
+                print(f"Progress {done}/{len(tasks)}: pickup {selected} failed ({e!r}), using the uninformed prior")
+                properties, difference, seconds = fallback, None, {}
+            yield selected, properties, difference, seconds
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def predict_pickups(columns, stored_fingerprints):
+    """
+    Fits the models of all pickups to the daily pollution columns, returns the properties to write per pickup id and
+    the differences between NUTS and the conjugate normal model. The seconds spent per model are recorded as the
+    model.* spans of the metrics.
+    """
+    pickups = list(stored_fingerprints)
+    pickup_ids, pollution, dates, offsets = group_pollution(*columns)
+    mu_hat = np.mean(pollution)
+    sigma_hat = np.std(pollution, ddof=1) + 1e-6
+    uninformed_probability = np.mean(pollution <= beta_max)
+    uninformed_cdf = np.mean(pollution[:, None] <= np.array(CDF_THRESHOLDS), axis=0).tolist()
+
+    counts, means, sse, sigmas = pickup_statistics(pollution, offsets)
+    # the CDFs broadcast the statistics of the pickups (rows) against the thresholds (columns)
+    grid = np.array(CDF_THRESHOLDS)
+    with metrics.span("model.t"):
+        t_probs = t_probabilities(counts, means, sigmas, beta_max)
+        t_cdfs = t_probabilities(counts[:, None], means[:, None], sigmas[:, None], grid)
+    with metrics.span("model.normal"):
+        n_probs = normal_probabilities(means, sigmas, beta_max)
+        n_cdfs = normal_probabilities(means[:, None], sigmas[:, None], grid)
+    with metrics.span("model.bayesian"):
+        conjugate_probs, conjugate_mus, conjugate_sigmas = conjugate_normal_model(counts, means, sse,
+                                                                                  [beta_max] + CDF_THRESHOLDS)
+        conjugate = list(zip(conjugate_probs[:, 0], conjugate_mus, conjugate_sigmas, conjugate_probs[:, 1:]))
+    index = {selected: i for i, selected in enumerate(pickup_ids) if counts[i] > 2}
+    fitted = [selected for selected in pickups if selected in index]
+    fingerprints = pollution_fingerprints(pollution, dates, offsets)
+    if INCREMENTAL:
+        fitted = [selected for selected in fitted
+                  if stored_fingerprints[selected] != fingerprints[index[selected]]]
+        print(f"{len(index) - len(fitted)} pickups are unchanged since the last run, fitting {len(fitted)}")
+    series = {selected: pollution[offsets[index[selected]]:offsets[index[selected] + 1]].tolist()
+              for selected in fitted}
+
+    normal_posteriors, mixture_posteriors = {}, {}
+    if BATCHED_INFERENCE and fitted:
+        fitted_series = [series[selected] for selected in fitted]
+        if BAYESIAN_MODE != "conjugate":
+            pooling = {"mu_hat": mu_hat, "sigma_hat": sigma_hat} if PARTIAL_POOLING else {}
+            with metrics.span("model.bayesian"):
+                normal_posteriors = dict(zip(fitted, fit_batched(batched_normal_model, fitted_series, ["mu", "sigma"],
+                                                                 BATCHED_INFERENCE, **pooling)))
+        with metrics.span("model.mixture"):
+            mixture_posteriors = dict(zip(fitted, fit_batched(
+                batched_tri_normal_model, fitted_series, MIXTURE_SITES, BATCHED_INFERENCE)))
+
+    uninformed = uninformed_properties(uninformed_probability, uninformed_cdf, mu_hat, sigma_hat)
+    results = {selected: uninformed for selected in pickups if selected not in index}
+    tasks = []
+    for selected in fitted:
+        i = index[selected]
+        results[selected] = {
+            "t_prob": {"prob": t_probs[i], "dist": {"mu": means[i], "sigma": sigmas[i], "n": int(counts[i])}},
+            "normal_prob": {"prob": n_probs[i], "dist": {"mu": means[i], "sigma": sigmas[i]}},
+            "t_prob_cdf": t_cdfs[i].tolist(),
+            "normal_prob_cdf": n_cdfs[i].tolist(),
+            "pollution_fingerprint": fingerprints[i]
+        }
+        run_nuts = BAYESIAN_MODE == "nuts" or (BAYESIAN_MODE == "validate" and (
+                VALIDATION_PICKUPS is None or len(tasks) < VALIDATION_PICKUPS))
+        tasks.append((selected, series[selected], conjugate[i], run_nuts,
+                      normal_posteriors.get(selected), mixture_posteriors.get(selected)))
+
+    # pickups of a batched fit only need the posterior predictive, which is not worth a process pool
+    workers = 1 if BATCHED_INFERENCE else PICKUP_WORKERS
+    fallback = {name: uninformed[name]
+                for name in ["bayesian_prob", "bayesian_prob_mixed", "bayesian_prob_cdf", "bayesian_prob_mixed_cdf"]}
+    # a pickup whose fit failed is written without fingerprint, so that the next incremental run fits it again
+    fallback["pollution_fingerprint"] = None
+    differences = []
+    with metrics.span("fit_pickups") as timer, metrics.profiled("fit_pickups"):
+        for selected, properties, difference, seconds in fit_pickups(tasks, fallback, workers):
+            results[selected].update(properties)
+            if difference is not None:
+                differences.append(difference)
+            for name, value in seconds.items():
+                metrics.observe(f"model.{name}", value)
+    metrics.throughput("pickups_fitted", len(tasks), timer.seconds)
+    return results, differences
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux, pickups may be fitted in worker processes
+    return dict(peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                peak_rss_children_mb=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+
+def run_benchmark(columns, stored_fingerprints, output_file=BENCHMARK_FILE):
+    """
+    Fits the models of all pickups without writing the results and appends the throughput, the seconds spent per
+    model (summed over workers) and the peak memory as a JSON line to output_file.
+    """
+    start = time.time()
+    results, differences = predict_pickups(columns, stored_fingerprints)
+    seconds = time.time() - start
+    timings = {name[len("model."):]: stats["seconds"] for name, stats in metrics.snapshot()["spans"].items()
+               if name.startswith("model.")}
+    entry = dict(data_source=DATA_SOURCE, pickups=len(results), observations=len(columns[2]), seconds=seconds,
+                 pickups_per_second=len(results) / seconds, model_seconds=timings, bayesian_mode=BAYESIAN_MODE,
+                 mixture_inference=MIXTURE_INFERENCE, batched_inference=BATCHED_INFERENCE, workers=PICKUP_WORKERS,
+                 **_peak_rss_mb())
+    print(json.dumps(entry))
+    with open(output_file, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+    report_disagreement(differences)
+    return entry
 
 
 if __name__ == "__main__":
-    with GraphDatabase.driver(URI, auth=AUTH) as driver:
-        driver.verify_connectivity()
-        print("Connection successful")
-        session = driver.session()
-
-        avg_pollution_per_pickup_and_day = session.execute_read(get_avg_pickup_event_pollution)
-        pickups = session.execute_read(get_pickups)
-        print(avg_pollution_per_pickup_and_day[0])
-
-        pickups = list(set([i['p2.id'] for i in pickups]))
-        pickup_pollution = [i['avgtc'] for i in avg_pollution_per_pickup_and_day]
-        mu_hat = np.mean(pickup_pollution)
-        sigma_hat = np.std(pickup_pollution, ddof=1) + 1e-6
-        uninformed_probability = len([i for i in pickup_pollution if i <= beta_max]) / len(pickup_pollution)
-
-        for selected in pickups:
-            print(f"Progress {pickups.index(selected)}/{len(pickups)}")
-            pickup_pollution = [i['avgtc'] for i in avg_pollution_per_pickup_and_day if i['p2.id'] == selected]
-            if len(pickup_pollution) <= 2:
-                session.execute_write(write_property_to_pickup, selected, "t_prob", {
-                    "prob": uninformed_probability,
-                    "dist": {"mu": mu_hat, "sigma": sigma_hat, "n": "1"}
-                })
-                session.execute_write(write_property_to_pickup, selected, "normal_prob", {
-                    "prob": uninformed_probability,
-                    "dist": {"mu": mu_hat, "sigma": sigma_hat}
-                })
-                session.execute_write(write_property_to_pickup, selected, "bayesian_prob", {
-                    "prob": uninformed_probability,
-                    "dist": {"mu": mu_hat, "sigma": sigma_hat}
-                })
-                session.execute_write(write_property_to_pickup, selected, "bayesian_prob_mixed", uninformed_probability)
-                continue
-            print(pickup_pollution)
-            mu_hat = np.mean(pickup_pollution)
-            sigma_hat = np.std(pickup_pollution, ddof=1) + 1e-6
-            normal_dist = dist.Normal(mu_hat, sigma_hat)
-
-            n = len(pickup_pollution)
-            t_score = (beta_max - mu_hat) / (sigma_hat / np.sqrt(n))
-            t_prob = t.cdf(t_score, df=n - 1)
-            n_score = (beta_max - mu_hat) / sigma_hat
-            n_prob = norm.cdf(n_score)
-
-            data = torch.tensor(pickup_pollution)
-            nuts_kernel = NUTS(normal_model)
-            mcmc = MCMC(nuts_kernel, num_samples=500, warmup_steps=100)
-            mcmc.run(data)
-
-            # Extract posterior samples
-            posterior_samples = mcmc.get_samples()
-            bayesian_prob, bayesian_mu, bayesian_sigma = predictive_model(posterior_samples, beta_max)
-
-            # write the results
-            session.execute_write(write_property_to_pickup, selected, "t_prob", {
-                "prob": t_prob,
-                "dist": {"mu": mu_hat, "sigma": sigma_hat, "n": n}
-            })
-            session.execute_write(write_property_to_pickup, selected, "normal_prob", {
-                "prob": n_prob,
-                "dist": {"mu": mu_hat, "sigma": sigma_hat}
-            })
-
-            session.execute_write(write_property_to_pickup, selected, "bayesian_prob", {
-                "prob": bayesian_prob,
-                "dist": {
-                    "mu": bayesian_mu.item(),
-                    "sigma": bayesian_sigma.item()
-                }
-            })
-
-            data = torch.tensor(pickup_pollution)
-            nuts_kernel = NUTS(tri_normal_model)
-            mcmc = MCMC(nuts_kernel, num_samples=500, warmup_steps=100)
-            mcmc.run(data)
-            # print(mcmc.summary())
-            posterior_samples = mcmc.get_samples()
-            bayesian_prob_mixed, b_mu1, b_s1, b_mu2, b_s2, b_mu3, b_s3, b_w1, b_w2 = predictive_model_tri(
-                posterior_samples, beta_max)
-
-            session.execute_write(write_property_to_pickup, selected, "bayesian_prob_mixed", {
-                "prob": bayesian_prob_mixed,
-                "dist": {
-                    "mu1": b_mu1.item(),
-                    "sigma1": b_s1.item(),
-                    "mu2": b_mu2.item(),
-                    "sigma2": b_s2.item(),
-                    "mu3": b_mu3.item(),
-                    "sigma3": b_s3.item(),
-                    "weights": [b_w1.item(), b_w2.item()]
-                }
-            })
+    """
+    Change the COMMAND variable to one of the following:
+    - predict: fits the models of all pickups and writes their properties to the KG
+    - snapshot: saves the daily pollution of the KG to SNAPSHOT_FILE
+    - benchmark: fits the models of all pickups of DATA_SOURCE without writing them and appends pickups/sec, the
+      seconds per model and the peak memory to BENCHMARK_FILE
+    - rebuild-aggregates: recomputes the materialized report scores and PollutionDay nodes from scratch
+    """
+    COMMAND = "predict"
+
+    if COMMAND == "benchmark" and DATA_SOURCE != "neo4j":
+        run_benchmark(*load_pollution(DATA_SOURCE))
+        metrics.report()
+    else:
+        with GraphDatabase.driver(URI, auth=AUTH) as driver:
+            driver.verify_connectivity()
+            print("Connection successful")
+            session = driver.session()
+            if AGGREGATED_POLLUTION:
+                with metrics.span("db.create_report_index"):
+                    create_report_index(driver, session)
+            if COMMAND == "rebuild-aggregates":
+                refresh_pollution_aggregates(session, rebuild=True)
+            columns, stored_fingerprints = load_pollution("neo4j", session)
+
+            if COMMAND == "predict":
+                results, differences = predict_pickups(columns, stored_fingerprints)
+
+                # write the results
+                with metrics.span("db.create_pickup_constraint"):
+                    create_pickup_constraint(driver, session)
+                write_pickup_properties(session, results)
+
+                report_disagreement(differences)
+
+            if COMMAND == "snapshot":
+                save_pollution_snapshot(columns, stored_fingerprints)
+
+            if COMMAND == "benchmark":
+                run_benchmark(columns, stored_fingerprints)
+
+            metrics.report()
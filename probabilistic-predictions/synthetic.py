@@ -0,0 +1,31 @@
+"""
+Synthetic daily pollution of LAYER_2 pickups, in the shape of get_avg_pickup_event_pollution in main.py, to run and
+benchmark the pipeline without a KG.
+"""
+import numpy as np
+
+# pickups observe a day with a pickup specific rate, the daily pollution is drawn from a mixture of clean days,
+# typical days and heavily polluted days like the components of tri_normal_model
+START_DATE = "2024-01-01"
+ACTIVITY_RATE = (1.0, 3.0)
+MIXTURE_WEIGHTS = (0.1, 0.5, 0.4)
+MIXTURE_MEANS = (0.0, 0.095, 0.08)
+MIXTURE_STDS = (0.005, 0.01, 0.03)
+
+
+def generate_pollution(num_pickups, days=120, seed=0):
+    """
+    Returns the pickup ids, dates and average pollution of the observed days (one entry per pickup and day) and the
+    ids of all pickups, including pickups without observations.
+    """
+    rng = np.random.default_rng(seed)
+    pickup_ids = np.array([f"synthetic-{i:06d}" for i in range(num_pickups)])
+    rates = rng.beta(*ACTIVITY_RATE, size=num_pickups)
+    weights = rng.dirichlet(MIXTURE_WEIGHTS, size=num_pickups)
+
+    pickups, day = np.nonzero(rng.random((num_pickups, days)) < rates[:, None])
+    cumulative = np.cumsum(weights[pickups], axis=1)
+    components = (rng.random(len(pickups))[:, None] > cumulative[:, :-1]).sum(axis=1)
+    values = rng.normal(np.take(MIXTURE_MEANS, components), np.take(MIXTURE_STDS, components))
+    dates = (np.datetime64(START_DATE) + day).astype(str)
+    return pickup_ids[pickups], dates, np.maximum(values, 0), pickup_ids